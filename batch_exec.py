@@ -6,6 +6,24 @@ import thread
 import subprocess
 import functools
 import time
+import threading
+import tempfile
+import select
+import errno
+import signal
+import traceback
+from tracing import TracedPopen
+
+PACKAGE_SETTINGS = "SubstanceGit.sublime-settings"
+
+# full log file of the last batch per window
+LOGS = {}
+
+# the current batch of each window, for cancelling
+BATCHES = {}
+
+# batches waiting for the current batch of their window to finish
+QUEUED = {}
 
 # TODO: is it possible to import ProcessListener and AsyncProcess from Default.exec ?
 
@@ -16,15 +34,130 @@ class ProcessListener(object):
     def on_finished(self, proc):
         pass
 
+class ProcessReactor(object):
+    """Reads the pipes of all running AsyncProcesses on one shared thread.
+
+    Output is forwarded in the order it becomes readable. A process is
+    reported as finished once both pipes are closed and it has exited.
+    poll() is used where available, select() cannot watch descriptors
+    above FD_SETSIZE. If the thread fails, the processes it watched are
+    killed and reported as finished, and the next process starts a new one.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.pipes = {}
+        self.open_pipes = {}
+        self.exiting = []
+        self.thread = None
+        self.wakeup = None
+
+    def add(self, process):
+        with self.lock:
+            if self.wakeup == None:
+                self.wakeup = os.pipe()
+            count = 0
+            for pipe in (process.proc.stdout, process.proc.stderr):
+                if pipe:
+                    self.pipes[pipe.fileno()] = (process, pipe)
+                    count += 1
+            self.open_pipes[process] = count
+            if count == 0:
+                self.exiting.append(process)
+            if self.thread == None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self.run)
+                self.thread.daemon = True
+                self.thread.start()
+        os.write(self.wakeup[1], b"x")
+
+    def wait(self, fds, timeout):
+        # the descriptors which are readable or closed
+        if not hasattr(select, "poll"):
+            return select.select(fds, [], [], timeout)[0]
+        poller = select.poll()
+        for fd in fds:
+            poller.register(fd, select.POLLIN | select.POLLPRI)
+        events = poller.poll(None if timeout == None else int(timeout * 1000))
+        return [fd for fd, event in events]
+
+    def run(self):
+        try:
+            self.loop()
+        except Exception:
+            print("Process reactor failed, finishing its processes")
+            traceback.print_exc()
+            self.fail()
+
+    def fail(self):
+        with self.lock:
+            # processes added from now on get a new thread
+            self.thread = None
+            processes = set([process for process, pipe in self.pipes.values()] + self.exiting)
+            pipes = [pipe for process, pipe in self.pipes.values()]
+            self.pipes = {}
+            self.open_pipes = {}
+            self.exiting = []
+        for pipe in pipes:
+            try:
+                pipe.close()
+            except (IOError, OSError):
+                pass
+        for process in processes:
+            listener = process.listener
+            process.kill()
+            if listener:
+                listener.on_finished(process)
+
+    def loop(self):
+        while True:
+            with self.lock:
+                fds = list(self.pipes.keys()) + [self.wakeup[0]]
+                # poll for exit codes while processes are closing down
+                timeout = 0.05 if len(self.exiting) > 0 else None
+            try:
+                readable = self.wait(fds, timeout)
+            except (select.error, OSError) as e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                raise
+            for fd in readable:
+                if fd == self.wakeup[0]:
+                    os.read(fd, 512)
+                    continue
+                with self.lock:
+                    if not fd in self.pipes:
+                        continue
+                    process, pipe = self.pipes[fd]
+                data = os.read(fd, 2**15)
+                if data:
+                    process.on_data(data)
+                    continue
+                with self.lock:
+                    del self.pipes[fd]
+                    self.open_pipes[process] -= 1
+                    if self.open_pipes[process] == 0:
+                        del self.open_pipes[process]
+                        self.exiting.append(process)
+                pipe.close()
+            with self.lock:
+                exited = [process for process in self.exiting if process.proc.poll() != None]
+                for process in exited:
+                    self.exiting.remove(process)
+            for process in exited:
+                process.on_exit()
+
+REACTOR = ProcessReactor()
+
 # Encapsulates subprocess.Popen, forwarding stdout to a supplied
-# ProcessListener (on a separate thread)
+# ProcessListener (on a shared reactor thread, or separate threads on Windows)
 class AsyncProcess(object):
 
     def __init__(self, arg_list, env, listener,
             # "path" is an option in build systems
             path="",
             # "shell" is an options in build systems
-            shell=False):
+            shell=False,
+            cwd=None):
 
         self.listener = listener
         self.killed = False
@@ -49,12 +182,24 @@ class AsyncProcess(object):
         for k, v in proc_env.iteritems():
             proc_env[k] = os.path.expandvars(v).encode(sys.getfilesystemencoding())
 
-        self.proc = subprocess.Popen(arg_list, stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE, startupinfo=startupinfo, env=proc_env, shell=shell)
+        # On POSIX the process gets its own process group, so that kill()
+        # also stops the processes it spawned (ssh, credential helpers)
+        preexec_fn = None
+        if os.name != "nt":
+            preexec_fn = os.setsid
+
+        self.proc = TracedPopen(arg_list, stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE, startupinfo=startupinfo, env=proc_env, shell=shell, cwd=cwd,
+            preexec_fn=preexec_fn)
 
         if path:
             os.environ["PATH"] = old_path
 
+        # select() does not work with pipes on Windows
+        if os.name != "nt":
+            REACTOR.add(self)
+            return
+
         if self.proc.stdout:
             thread.start_new_thread(self.read_stdout, ())
 
@@ -64,7 +209,13 @@ class AsyncProcess(object):
     def kill(self):
         if not self.killed:
             self.killed = True
-            self.proc.terminate()
+            try:
+                if os.name == "nt":
+                    self.proc.terminate()
+                else:
+                    os.killpg(self.proc.pid, signal.SIGTERM)
+            except OSError:
+                pass # already gone
             self.listener = None
 
     def poll(self):
@@ -73,11 +224,23 @@ class AsyncProcess(object):
     def exit_code(self):
         return self.proc.poll()
 
+    def on_data(self, data):
+        self.proc.trace_read(len(data))
+        listener = self.listener
+        if listener:
+            listener.on_data(self, data)
+
+    def on_exit(self):
+        listener = self.listener
+        if listener:
+            listener.on_finished(self)
+
     def read_stdout(self):
         while True:
             data = os.read(self.proc.stdout.fileno(), 2**15)
 
             if data != "":
+                self.proc.trace_read(len(data))
                 if self.listener:
                     self.listener.on_data(self, data)
             else:
@@ -91,114 +254,327 @@ class AsyncProcess(object):
             data = os.read(self.proc.stderr.fileno(), 2**15)
 
             if data != "":
+                self.proc.trace_read(len(data))
                 if self.listener:
                     self.listener.on_data(self, data)
             else:
                 self.proc.stderr.close()
                 break
 
-class BatchExecCommand(sublime_plugin.WindowCommand, ProcessListener):
+def decode(data, encoding):
+    if isinstance(data, bytes):
+        return data.decode(encoding, "replace")
+    return data
 
-    def run(self, commands = [], callbackCmd = None, callbackArgs = None, encoding = "utf-8"):
+class OutputSink(object):
+    """Writes output to a panel in coalesced edits.
 
-        if not hasattr(self, 'output_view'):
-            # Try not to call get_output_panel until the regexes are assigned
-            self.output_view = self.window.get_output_panel("exec")
+    Data can be written from any thread. It is flushed to the view every
+    `interval` ms, or right away once `threshold` characters are waiting. The
+    view keeps only the last `max_chars` characters, the complete output is
+    written to a log file.
+    """
 
-        self.window.get_output_panel("exec")
+    def __init__(self, view, encoding, interval=50, threshold=2**16, max_chars=2**20):
+        self.view = view
+        self.encoding = encoding
+        self.interval = interval
+        self.threshold = threshold
+        self.max_chars = max_chars
+        self.lock = threading.Lock()
+        self.chunks = []
+        self.size = 0
+        self.scheduled = False
+        self.urgent = False
+        self.trimmed = False
+        fd, self.log_path = tempfile.mkstemp(prefix="substance-batch-", suffix=".log")
+        self.log = os.fdopen(fd, "wb")
+
+    def write(self, data):
+        text = decode(data, self.encoding)
+        with self.lock:
+            self.chunks.append(text)
+            self.size += len(text)
+            if self.size >= self.threshold and not self.urgent:
+                self.urgent = True
+                delay = 0
+            elif not self.scheduled:
+                self.scheduled = True
+                delay = self.interval
+            else:
+                return
+        sublime.set_timeout(self.flush, delay)
+
+    def flush(self):
+        with self.lock:
+            text = "".join(self.chunks)
+            self.chunks = []
+            self.size = 0
+            self.scheduled = False
+            self.urgent = False
+        if not text:
+            return
+
+        # Normalize newlines, Sublime Text always uses a single \n separator
+        # in memory.
+        text = text.replace('\r\n', '\n').replace('\r', '\n')
+
+        if not self.log.closed:
+            self.log.write(text.encode("utf-8"))
+            self.log.flush()
+
+        view = self.view
+        selection_was_at_end = (len(view.sel()) == 1
+            and view.sel()[0]
+                == sublime.Region(view.size()))
+        view.set_read_only(False)
+        edit = view.begin_edit()
+        view.insert(edit, view.size(), text)
+        if view.size() > self.max_chars:
+            # drop whole lines from the top, the log file keeps everything
+            cut = view.size() - self.max_chars
+            line_end = view.find("\n", cut)
+            if line_end != None and line_end.end() > 0:
+                cut = line_end.end()
+            view.erase(edit, sublime.Region(0, cut))
+            view.insert(edit, 0, "[Output truncated, full log: %s]\n"%self.log_path)
+        if selection_was_at_end:
+            view.show(view.size())
+        view.end_edit(edit)
+        view.set_read_only(True)
+
+    def close(self):
+        self.flush()
+        self.log.close()
+
+class BatchJob(ProcessListener):
+    """A command of a batch and the output it produced so far."""
+
+    def __init__(self, batch, command):
+        self.batch = batch
+        self.cmd = command['cmd']
+        self.working_dir = command['working_dir']
+        self.output = []
+        self.proc = None
+        self.start_time = time.time()
+        self.elapsed = 0
+        self.exit_code = None
+
+    def on_data(self, proc, data):
+        if self.batch.buffered:
+            self.output.append(data)
+        else:
+            self.batch.append_data(data)
+
+    def on_finished(self, proc):
+        sublime.set_timeout(functools.partial(self.batch.finish, self), 0)
 
+class Batch(object):
+    """The commands of one batch_exec call, run in the output panel of a window.
+
+    Only one batch of a window runs at a time, a batch started meanwhile
+    waits in QUEUED until the current one is done.
+    """
+
+    def __init__(self, window, output_view, commands, callbackCmd=None, callbackArgs=None,
+            encoding="utf-8", max_parallel=1):
+        self.window = window
+        self.output_view = output_view
         self.commands = commands
         self.callbackCmd = callbackCmd
         self.callbackArgs = callbackArgs
         self.encoding = encoding
 
-        self.proc = None
+        # with more than one command at a time, the output of each command is
+        # buffered and written as one block when it finishes
+        self.max_parallel = max(1, max_parallel)
+        self.buffered = self.max_parallel > 1
+        self.pending = list(commands)
+        self.running = []
+        self.results = []
+        self.sink = None
+        self.started = False
+        self.done = False
+        self.cancelled = False
+        self.timeout = 0
+        self.start_time = None
+
+    def submit(self):
+        window_id = self.window.id()
+        current = BATCHES.get(window_id)
+        if current != None and not current.done:
+            QUEUED.setdefault(window_id, []).append(self)
+            sublime.status_message("Batch queued")
+            return
+        self.start_batch()
+
+    def start_batch(self):
+        window_id = self.window.id()
+        self.window.get_output_panel("exec")
+
+        settings = sublime.load_settings(PACKAGE_SETTINGS)
+        self.sink = OutputSink(self.output_view, self.encoding,
+            interval=settings.get("exec_flush_interval", 50),
+            threshold=settings.get("exec_flush_chars", 2**16),
+            max_chars=settings.get("exec_panel_max_chars", 2**20))
+        previous_log = LOGS.get(window_id)
+        if previous_log and os.path.exists(previous_log):
+            os.remove(previous_log)
+        LOGS[window_id] = self.sink.log_path
+        BATCHES[window_id] = self
+
+        self.started = True
+        self.timeout = settings.get("command_timeout", 0)
+        self.start_time = time.time()
 
         sublime.status_message("Executing")
         self.window.run_command("show_panel", {"panel": "output.exec"})
 
-        self.stepper = self.__stepper__()
-        self.stepper.next()
+        self.start_next()
+
+    def start_next(self):
+        while len(self.pending) > 0 and len(self.running) < self.max_parallel:
+            self.start(BatchJob(self, self.pending.pop(0)))
+
+        if len(self.pending) == 0 and len(self.running) == 0 and not self.done:
+            self.done = True
+            if len(self.results) > 1:
+                self.append_data(self.summary())
+            self.sink.close()
 
-    def __stepper__(self):
+            # finally call a registered callback command
+            if not self.callbackCmd == None and not self.cancelled:
+                print("Executing callback: %s"%self.callbackCmd)
+                self.window.run_command(self.callbackCmd, self.callbackArgs)
+
+            start_queued(self.window.id())
+
+    def start(self, job):
 
         err_type = OSError
         if os.name == "nt":
             err_type = WindowsError
 
-        for command in self.commands:
-            try:
-                cmd = command['cmd']
-                working_dir = command['working_dir']
-
-                # Default the working_dir to the current files directory if no working directory was given
-                if (working_dir == "" and self.window.active_view()
-                                and self.window.active_view().file_name()):
-                    working_dir = os.path.dirname(self.window.active_view().file_name())
-
-                # Change to the working dir, rather than spawning the process with it,
-                # so that emitted working dir relative path names make sense
-                if working_dir != None and working_dir != "":
-                    os.chdir(working_dir)
-
-                self.append_data("%s $ %s\n"%(working_dir, " ".join(cmd))) 
-                self.proc = AsyncProcess(cmd, {}, self)
-                yield self
-
-            except err_type as e:
-                print "%s"%(str(e))
-                self.append_data(str(e) + "\n")
-                self.append_data("[cmd:  " + str(commands) + "]\n")
-                self.append_data("[dir:  " + str(os.getcwdu()) + "]\n")
-                if "PATH" in merged_env:
-                    self.append_data("[path: " + str(merged_env["PATH"]) + "]\n")
-                else:
-                    self.append_data("[path: " + str(os.environ["PATH"]) + "]\n")
+        working_dir = job.working_dir
 
-                self.append_data("[Finished]\n")
+        # Default the working_dir to the current files directory if no working directory was given
+        if (working_dir == "" and self.window.active_view()
+                        and self.window.active_view().file_name()):
+            working_dir = os.path.dirname(self.window.active_view().file_name())
+        if working_dir == "":
+            working_dir = None
+        job.working_dir = working_dir
 
-        # finally call a registered callback command
-        if not self.callbackCmd == None:
-          print("Executing callback: %s"%self.callbackCmd)
-          self.window.run_command(self.callbackCmd, self.callbackArgs)
+        try:
+            if not self.buffered:
+                self.append_data("%s $ %s\n"%(working_dir, " ".join(job.cmd)))
+            job.proc = AsyncProcess(job.cmd, {}, job, cwd=working_dir)
+            self.running.append(job)
+            if self.timeout:
+                sublime.set_timeout(functools.partial(self.expire, job), int(self.timeout * 1000))
+
+        except err_type as e:
+            print("%s"%(str(e)))
+            message = ("%s\n[cmd:  %s]\n[dir:  %s]\n[path: %s]\n[Finished]\n"
+                %(str(e), str(job.cmd), str(working_dir), str(os.environ["PATH"])))
+            if self.buffered:
+                message = "%s $ %s\n%s"%(working_dir, " ".join(job.cmd), message)
+            self.append_data(message)
+            job.exit_code = -1
+            self.results.append(job)
+
+    def summary(self):
+        failed = [job for job in self.results if job.exit_code != 0 and job.exit_code != None]
+        lines = ["", "[Batch finished in %.1fs: %d succeeded, %d failed]"
+            %(time.time() - self.start_time, len(self.results) - len(failed), len(failed))]
+        for job in failed:
+            lines.append("  failed: %s $ %s (exit code %d)"%(job.working_dir, " ".join(job.cmd), job.exit_code))
+        slowest = sorted(self.results, key=lambda job: job.elapsed, reverse=True)[:3]
+        for job in slowest:
+            lines.append("  slowest: %.1fs %s $ %s"%(job.elapsed, job.working_dir, " ".join(job.cmd)))
+        return "\n".join(lines) + "\n"
 
     def append_data(self, data):
+        self.sink.write(data)
+
+    def finish(self, job):
+        # the job may have been killed before
+        if not job in self.running:
+            return
+        proc = job.proc
+        job.elapsed = time.time() - proc.start_time
+        job.exit_code = proc.exit_code()
+        if job.exit_code == 0 or job.exit_code == None:
+            finished = ("[Finished in %.1fs]\n") % (job.elapsed)
+        else:
+            finished = ("[Finished in %.1fs with exit code %d]\n") % (job.elapsed, job.exit_code)
+        self.report(job, finished)
+
+    def abort(self, job, message):
+        job.proc.kill()
+        job.elapsed = time.time() - job.proc.start_time
+        job.exit_code = -1
+        self.report(job, message)
+
+    def expire(self, job):
+        if job in self.running:
+            self.abort(job, "[Timed out after %.1fs]\n" % (time.time() - job.proc.start_time))
+
+    def cancel(self):
+        """Kills the running commands and drops the pending ones."""
+        if self.done or not self.started:
+            return False
+        self.cancelled = True
+        self.pending = []
+        for job in list(self.running):
+            self.abort(job, "[Cancelled after %.1fs]\n" % (time.time() - job.proc.start_time))
+        return True
+
+    def report(self, job, finished):
+        if self.buffered:
+            output = decode(b"".join(job.output), self.encoding)
+            self.append_data(u"%s $ %s\n%s%s"%(job.working_dir, " ".join(job.cmd), output, finished))
+        else:
+            self.append_data(finished)
 
-        try:
-            str = data.decode(self.encoding)
-        except:
-            str = "[Decode error - output not " + self.encoding + "]\n"
+        self.running.remove(job)
+        self.results.append(job)
+        self.start_next()
 
-        # Normalize newlines, Sublime Text always uses a single \n separator
-        # in memory.
-        str = str.replace('\r\n', '\n').replace('\r', '\n')
-
-        selection_was_at_end = (len(self.output_view.sel()) == 1
-            and self.output_view.sel()[0]
-                == sublime.Region(self.output_view.size()))
-        self.output_view.set_read_only(False)
-        edit = self.output_view.begin_edit()
-        self.output_view.insert(edit, self.output_view.size(), str)
-        if selection_was_at_end:
-            self.output_view.show(self.output_view.size())
-        self.output_view.end_edit(edit)
-        self.output_view.set_read_only(True)
-
-    def finish(self, proc):
-        elapsed = time.time() - proc.start_time
-        exit_code = proc.exit_code()
-        if exit_code == 0 or exit_code == None:
-            self.append_data(("[Finished in %.1fs]\n") % (elapsed))
-        else:
-            self.append_data(("[Finished in %.1fs with exit code %d]\n") % (elapsed, exit_code))
+def start_queued(window_id):
+    # the callback of the finished batch may have started the next one itself
+    current = BATCHES.get(window_id)
+    queued = QUEUED.get(window_id)
+    if queued and (current == None or current.done):
+        queued.pop(0).start_batch()
 
-        try:
-            self.stepper.next()
-        except:
-            pass
+class BatchExecCommand(sublime_plugin.WindowCommand):
 
-    def on_data(self, proc, data):
-        sublime.set_timeout(functools.partial(self.append_data, data), 0)
+    def run(self, commands = [], callbackCmd = None, callbackArgs = None, encoding = "utf-8", max_parallel = 1):
 
-    def on_finished(self, proc):
-        sublime.set_timeout(functools.partial(self.finish, proc), 0)
+        if not hasattr(self, 'output_view'):
+            # Try not to call get_output_panel until the regexes are assigned
+            self.output_view = self.window.get_output_panel("exec")
+
+        self.batch = Batch(self.window, self.output_view, commands, callbackCmd, callbackArgs,
+            encoding, max_parallel)
+        self.batch.submit()
+
+class BatchExecCancelCommand(sublime_plugin.WindowCommand):
+
+    def run(self):
+        queued = QUEUED.pop(self.window.id(), [])
+        batch = BATCHES.get(self.window.id())
+        if (batch == None or not batch.cancel()) and not queued:
+            sublime.status_message("No batch running")
+            return
+        sublime.status_message("Batch cancelled")
+
+class BatchExecOpenLogCommand(sublime_plugin.WindowCommand):
+
+    def run(self):
+        path = LOGS.get(self.window.id())
+        if path == None or not os.path.exists(path):
+            sublime.status_message("No batch log available")
+            return
+        self.window.open_file(path)
@@ -0,0 +1,256 @@
+#!/usr/bin/env python
+"""Headless correctness checks for the status collection on generated repositories.
+
+Runs outside of Sublime Text like the benchmarks:
+
+    python bench/checks.py
+    python bench/checks.py status_parity
+
+Every check gets an empty directory and raises AssertionError on failure.
+"""
+
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import traceback
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path[:0] = [os.path.join(HERE, "stubs"), os.path.dirname(HERE)]
+
+import workspace
+import gitstatus
+import utils
+
+CHECKS = []
+
+def check(func):
+  CHECKS.append(func)
+  return func
+
+def create_repo(root, name, files=3):
+  folder = os.path.join(root, name)
+  workspace.create_module(folder, name, [], files)
+  return folder
+
+def try_git(folder, *args):
+  # like workspace.git, for commands which are expected to fail
+  return subprocess.call(["git"] + list(args), cwd=folder, env=workspace.GIT_ENV,
+    stdout=open(os.devnull, "w"), stderr=subprocess.STDOUT)
+
+COUNTS = ("staged", "conflicts", "changed", "untracked", "stashed", "ahead", "behind", "clean")
+FIELDS = COUNTS + ("branch", "remote", "sha", "upstream", "detached")
+
+def compare_paths(folder, **kwargs):
+  # the porcelain and the legacy status of `folder` must agree on every field
+  porcelain = gitstatus.gitstatus(folder, porcelain=True, **kwargs)
+  legacy = gitstatus.gitstatus(folder, porcelain=False, **kwargs)
+  for key in FIELDS:
+    assert porcelain[key] == legacy[key], "%s: porcelain %r, legacy %r" % (key, porcelain[key], legacy[key])
+  return porcelain, legacy
+
+@check
+def status_parity(root):
+  """Porcelain v2 and the legacy status agree on conflicts, renames and changes."""
+  folder = create_repo(root, "parity")
+  workspace.git(folder, "checkout", "-q", "-b", "feature")
+  workspace.write(os.path.join(folder, "file0.txt"), "feature\n")
+  workspace.commit_all(folder, "feature")
+  workspace.git(folder, "checkout", "-q", "master")
+  workspace.write(os.path.join(folder, "file0.txt"), "master\n")
+  workspace.commit_all(folder, "master")
+  assert try_git(folder, "merge", "-q", "feature") != 0, "expected a merge conflict"
+  workspace.write(os.path.join(folder, "file1.txt"), "modified\n")
+  workspace.git(folder, "mv", "file2.txt", "moved.txt")
+  workspace.write(os.path.join(folder, "new.txt"), "untracked\n")
+
+  for untracked in ("normal", "all"):
+    porcelain, legacy = compare_paths(folder, untracked=untracked)
+    assert (sorted([entry.short() for entry in porcelain["entries"]])
+      == sorted([entry.short() for entry in legacy["entries"]])), "entries differ"
+    assert (porcelain["conflicts"], porcelain["staged"], porcelain["changed"], porcelain["untracked"]) == (1, 1, 1, 1), \
+      "unexpected counts %r" % [porcelain[key] for key in COUNTS]
+
+@check
+def tracking_parity(root):
+  """Both status paths agree on detached heads, local upstreams and remotes with slashes."""
+  folder = create_repo(root, "tracking")
+  workspace.git(folder, "checkout", "-q", "--detach")
+  porcelain, legacy = compare_paths(folder)
+  assert porcelain["detached"] and len(porcelain["branch"]) == 41, porcelain["branch"]
+
+  workspace.git(folder, "checkout", "-q", "-b", "local", "master")
+  workspace.git(folder, "branch", "-q", "--set-upstream-to=master")
+  workspace.write(os.path.join(folder, "file0.txt"), "local\n")
+  workspace.commit_all(folder, "local")
+  porcelain, legacy = compare_paths(folder)
+  assert (porcelain["remote"], porcelain["upstream"], porcelain["ahead"]) == (".", "master", 1), \
+    [porcelain[key] for key in FIELDS]
+
+  remote = os.path.join(root, "remote.git")
+  workspace.git(root, "clone", "-q", "--bare", folder, remote)
+  workspace.git(folder, "remote", "add", "team/origin", remote)
+  workspace.git(folder, "fetch", "-q", "team/origin")
+  workspace.git(folder, "branch", "-q", "--set-upstream-to=team/origin/local")
+  porcelain, legacy = compare_paths(folder)
+  assert (porcelain["remote"], porcelain["upstream"]) == ("team/origin", "team/origin/local"), \
+    [porcelain[key] for key in FIELDS]
+
+@check
+def remote_without_merge(root):
+  """A branch with a remote but no merge ref has no upstream in both status paths."""
+  folder = create_repo(root, "nomerge")
+  workspace.git(folder, "config", "branch.master.remote", "origin")
+  for porcelain in (True, False):
+    stat = gitstatus.gitstatus(folder, porcelain=porcelain)
+    assert stat is not None, "no status (porcelain %s)" % porcelain
+    assert stat["upstream"] is None, "upstream %r (porcelain %s)" % (stat["upstream"], porcelain)
+    assert (stat["ahead"], stat["behind"]) == (0, 0)
+    assert stat["branch"] == "master"
+
+@check
+def nested_branch_update(root):
+  """The cached branch overview sees a moved branch below a ref subdirectory."""
+  folder = create_repo(root, "nested")
+  workspace.git(folder, "branch", "-q", "--track", "feature/x", "master")
+  cache = gitstatus.StatusCache()
+  branches = gitstatus.cached_branch_overview(cache, folder)
+  assert [(b.name, b.ahead) for b in branches if b.name == "feature/x"] == [("feature/x", 0)]
+
+  tree = subprocess.check_output(["git", "rev-parse", "HEAD^{tree}"], cwd=folder).strip()
+  commit = subprocess.check_output(["git", "commit-tree", "-p", "HEAD", "-m", "feature", tree],
+    cwd=folder, env=workspace.GIT_ENV).strip()
+  workspace.git(folder, "update-ref", "refs/heads/feature/x", commit)
+  branches = gitstatus.cached_branch_overview(cache, folder)
+  assert [(b.name, b.ahead) for b in branches if b.name == "feature/x"] == [("feature/x", 1)], \
+    "stale branch overview"
+
+@check
+def untracked_diff(root):
+  """The diff preview handles untracked files and directories."""
+  folder = create_repo(root, "untracked")
+  os.makedirs(os.path.join(folder, "generated", "deep"))
+  workspace.write(os.path.join(folder, "generated", "deep", "out.txt"), "generated\n")
+  workspace.write(os.path.join(folder, "new.txt"), "new\n")
+  entries = dict([(entry.path, entry) for entry in gitstatus.gitstatus(folder, untracked="normal")["entries"]])
+  assert sorted(entries) == ["generated/", "new.txt"], sorted(entries)
+  store = gitstatus.StatusStore(gitstatus.StatusCache())
+  text = store.diff(folder, entries["generated/"], None)
+  assert text is not None and "generated/deep/out.txt" in text, repr(text)
+  text = store.diff(folder, entries["new.txt"], None)
+  assert text is not None and "+new" in text, repr(text)
+
+def _interpreters():
+  # the CLI has to print the same records under python 2 and 3
+  found = [sys.executable]
+  for name in ("python2", "python3"):
+    try:
+      # version managers install shims for interpreters which are not there
+      if subprocess.call([name, "-c", "pass"], stdout=open(os.devnull, "w"), stderr=subprocess.STDOUT) == 0:
+        found.append(name)
+    except OSError:
+      pass
+  return found
+
+@check
+def cli_records(root):
+  """gitstatus.py prints text values and a null remote for detached heads under every python."""
+  folder = create_repo(root, "cli")
+  detached = create_repo(root, "detached")
+  workspace.git(detached, "checkout", "-q", "--detach")
+  script = os.path.join(os.path.dirname(HERE), "gitstatus.py")
+  for python in _interpreters():
+    for args in ([], ["--legacy"]):
+      output = subprocess.check_output([python, script] + args + [folder, detached], stderr=subprocess.STDOUT)
+      records = dict([(record.get("folder"), record) for record in
+        [json.loads(line) for line in output.decode("utf-8").splitlines()]])
+      for path in (folder, detached):
+        record = records[path]
+        where = "%s %s %s" % (python, " ".join(args), os.path.basename(path))
+        assert len(record["sha"]) == 40 and int(record["sha"], 16) >= 0, "%s: sha %r" % (where, record["sha"])
+        assert record["branch"] and not record["branch"].startswith("b'"), "%s: branch %r" % (where, record["branch"])
+      assert records[folder]["remote"] == "origin", records[folder]["remote"]
+      assert records[detached]["remote"] is None, "%s: remote %r" % (python, records[detached]["remote"])
+
+def _alive(pid):
+  # a killed child of a killed git may briefly linger as a zombie
+  try:
+    with open("/proc/%d/stat" % pid) as f:
+      return f.read().split(") ", 1)[1][0] != "Z"
+  except (IOError, OSError):
+    try:
+      os.kill(pid, 0)
+    except OSError:
+      return False
+    return True
+
+@check
+def fetch_bare_remotes(root):
+  """fetch_all fetches each repository once and kills fetches running past the timeout."""
+  info = workspace.generate(root, repos=3, depth=0, deps=0, files=2, dirty=0, untracked=0, stash=0, ahead=0, behind=0)
+  module0, module1, module2 = info["folders"]
+
+  # a new upstream commit for module0
+  upstream = os.path.join(root, "upstream")
+  workspace.git(root, "clone", "-q", os.path.join(root, "remotes", "module0.git"), upstream)
+  workspace.write(os.path.join(upstream, "file0.txt"), "upstream\n")
+  workspace.commit_all(upstream, "upstream")
+  workspace.git(upstream, "push", "-q", "origin", "master")
+
+  link = os.path.join(root, "module0-link")
+  os.symlink(module0, link)
+  repos = [{"path": module0, "remote": "origin"}, {"path": link, "remote": "origin"}, {"path": module1, "remote": "origin"}]
+  results = utils.fetch_all(repos, "git", workers=2, timeout=30)
+  assert len(results) == 2, "expected one fetch per repository, got %d" % len(results)
+  for paths, result in results:
+    assert result["ok"], "fetch failed in %s: %s" % (paths, result["error"])
+  assert gitstatus.gitstatus(module0)["behind"] == 1, "module0 did not see the upstream commit"
+
+  # an upload-pack that hangs, its process must be gone after the timeout
+  if os.name == "nt":
+    return
+  pidfile = os.path.join(root, "upload-pack.pid")
+  script = os.path.join(root, "slow-upload-pack")
+  workspace.write(script, "#!/bin/sh\necho $$ > %s\nexec sleep 30\n" % pidfile)
+  os.chmod(script, 0o755)
+  workspace.git(module2, "remote", "add", "slow", os.path.join(root, "remotes", "module2.git"))
+  workspace.git(module2, "config", "remote.slow.uploadpack", script)
+  start = time.time()
+  results = utils.fetch_all([{"path": module2, "remote": "slow"}], "git", timeout=1)
+  result = results[0][1]
+  assert result["timed_out"] and not result["ok"], "expected a timeout, got %r" % result
+  assert time.time() - start < 10, "the timeout was not enforced"
+  with open(pidfile) as f:
+    pid = int(f.read())
+  for i in range(50):
+    if not _alive(pid):
+      break
+    time.sleep(0.1)
+  assert not _alive(pid), "upload-pack %d survived the timeout" % pid
+
+def main(argv=None):
+  names = (sys.argv[1:] if argv is None else argv)
+  checks = [func for func in CHECKS if not names or func.__name__ in names]
+  root = tempfile.mkdtemp(prefix="substance-checks-")
+  failures = 0
+  try:
+    for func in checks:
+      folder = os.path.join(root, func.__name__)
+      os.makedirs(folder)
+      try:
+        func(folder)
+        print("ok      %s" % func.__name__)
+      except Exception:
+        failures += 1
+        print("FAILED  %s" % func.__name__)
+        traceback.print_exc()
+  finally:
+    shutil.rmtree(root)
+  print("%d of %d checks passed" % (len(checks) - failures, len(checks)))
+  return 1 if failures else 0
+
+if __name__ == "__main__":
+  sys.exit(main())
@@ -0,0 +1,216 @@
+#!/usr/bin/env python
+"""Headless benchmarks for status collection, discovery, rendering and batch exec.
+
+Runs outside of Sublime Text using the stubs in bench/stubs, with the
+Python 2 interpreter the plugin targets:
+
+    python bench/run.py --repos 20 --depth 2
+    python bench/run.py --save-baseline bench/baseline.json
+    python bench/run.py --baseline bench/baseline.json
+
+Every phase reports wall time, CPU time (including child processes) and the
+number of spawned subprocesses.
+"""
+
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path[:0] = [os.path.join(HERE, "stubs"), os.path.dirname(HERE)]
+
+import sublime
+import workspace
+
+SPAWNS = [0]
+_Popen = subprocess.Popen
+
+class CountingPopen(_Popen):
+
+  def __init__(self, *args, **kwargs):
+    SPAWNS[0] += 1
+    _Popen.__init__(self, *args, **kwargs)
+
+subprocess.Popen = CountingPopen
+
+import gitstatus
+import utils
+import git_status_command
+
+def cpu_time():
+  t = os.times()
+  return t[0] + t[1] + t[2] + t[3]
+
+def measure(name, func, repeat=1):
+  spawns = SPAWNS[0]
+  cpu = cpu_time()
+  start = time.time()
+  for i in range(repeat):
+    func()
+  return {
+    "name": name,
+    "wall": (time.time() - start) / repeat,
+    "cpu": (cpu_time() - cpu) / repeat,
+    "spawns": float(SPAWNS[0] - spawns) / repeat
+  }
+
+def bench_status(folders, workers, repeat):
+  results = []
+  for porcelain in (True, False):
+    name = "status %s (%d workers)" % ("porcelain" if porcelain else "legacy", workers)
+    results.append(measure(name, lambda: utils.parallel_map(
+      lambda folder: gitstatus.gitstatus(folder, git_command="git", porcelain=porcelain),
+      folders, workers), repeat))
+
+  settings = sublime.load_settings(git_status_command.PACKAGE_SETTINGS)
+  settings.set("git_command", "git")
+  settings.set("status_workers", workers)
+  window = sublime.Window(folders)
+  manager = git_status_command.GitStatusManager(window, window.new_file())
+
+  def refresh():
+    manager.update(force=True)
+    sublime.run_until(lambda: not manager.running)
+
+  results.append(measure("manager refresh, cold cache", refresh))
+  results.append(measure("manager refresh, warm cache", refresh, repeat))
+
+  def toggle():
+    manager.short = not manager.short
+    manager.render_results(folders)
+
+  results.append(measure("manager toggle short/long", toggle, repeat))
+  return results
+
+def bench_discovery(folders, workers, repeat):
+  def discover():
+    utils.PACKAGE_CACHE.clear()
+    for folder in folders:
+      utils.read_project_config(folder, "git", workers)
+
+  def load_index():
+    for folder in folders:
+      utils.load_project_index(folder, "git", workers)
+
+  for folder in folders:
+    index = utils.index_file(folder)
+    if os.path.exists(index):
+      os.remove(index)
+  utils.PROJECT_INDEXES.clear()
+  return [
+    measure("discovery, cold", discover, repeat),
+    measure("project index, first load", load_index),
+    measure("project index, cached", load_index, repeat)
+  ]
+
+def bench_render(folders, repeat):
+  window = sublime.Window(folders)
+  view = window.new_file()
+  manager = git_status_command.GitStatusManager(window, view)
+  changes = [[folder, "On branch master\n\nUnstaged:\n" + "\n".join(
+    ["  modified:   file%d.txt" % i for i in range(50)])] for folder in folders]
+  changed = [list(change) for change in changes]
+  changed[len(changed) // 2][1] += "\n  modified:   other.txt"
+
+  def render_full():
+    manager.blocks = []
+    manager.render(changes)
+
+  def render_one_changed():
+    manager.render(changes)
+    manager.render(changed)
+
+  return [
+    measure("render, full", render_full, repeat),
+    measure("render, unchanged", lambda: manager.render(changes), repeat),
+    measure("render, one block changed", render_one_changed, repeat)
+  ]
+
+def bench_batch(folders, parallel):
+  try:
+    import batch_exec
+  except ImportError as err:
+    print("Skipping batch exec benchmark: %s" % err)
+    return []
+  results = []
+  for max_parallel in sorted(set([1, parallel])):
+    def run():
+      window = sublime.Window(folders)
+      command = batch_exec.BatchExecCommand(window)
+      commands = [{"cmd": ["git", "status"], "working_dir": folder} for folder in folders]
+      command.run(commands, max_parallel=max_parallel)
+      sublime.run_until(lambda: command.batch.done)
+    results.append(measure("batch exec git status (max_parallel %d)" % max_parallel, run))
+  return results
+
+def report(results, baseline):
+  previous = {}
+  if baseline:
+    for result in baseline["results"]:
+      previous[result["name"]] = result
+  print("%-45s %10s %10s %8s %10s" % ("benchmark", "wall ms", "cpu ms", "spawns", "vs base"))
+  for result in results:
+    delta = ""
+    base = previous.get(result["name"])
+    if base and base["wall"] > 0:
+      delta = "%+.0f%%" % ((result["wall"] - base["wall"]) * 100.0 / base["wall"])
+    print("%-45s %10.1f %10.1f %8.1f %10s" % (result["name"], result["wall"] * 1000,
+      result["cpu"] * 1000, result["spawns"], delta))
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+  parser.add_argument("--repos", type=int, default=10, help="number of top level modules")
+  parser.add_argument("--depth", type=int, default=1, help="depth of the node_modules tree")
+  parser.add_argument("--deps", type=int, default=2, help="git dependencies per module")
+  parser.add_argument("--files", type=int, default=20, help="files per module")
+  parser.add_argument("--dirty", type=float, default=0.3)
+  parser.add_argument("--untracked", type=float, default=0.3)
+  parser.add_argument("--stash", type=float, default=0.1)
+  parser.add_argument("--ahead", type=float, default=0.2)
+  parser.add_argument("--behind", type=float, default=0.2)
+  parser.add_argument("--workers", type=int, default=8)
+  parser.add_argument("--repeat", type=int, default=3)
+  parser.add_argument("--workspace", help="reuse or keep the workspace in this directory")
+  parser.add_argument("--baseline", help="compare against a saved baseline")
+  parser.add_argument("--save-baseline", help="save the results as baseline")
+  args = parser.parse_args()
+
+  root = args.workspace or tempfile.mkdtemp(prefix="substance-bench-")
+  try:
+    if os.path.exists(os.path.join(root, "workspace")):
+      folders = sorted([os.path.join(root, "workspace", name)
+        for name in os.listdir(os.path.join(root, "workspace"))])
+    else:
+      start = time.time()
+      info = workspace.generate(root, repos=args.repos, depth=args.depth, deps=args.deps,
+        files=args.files, dirty=args.dirty, untracked=args.untracked, stash=args.stash,
+        ahead=args.ahead, behind=args.behind)
+      folders = info["folders"]
+      print("Generated %d repositories in %.1fs" % (info["repositories"], time.time() - start))
+
+    results = []
+    results.extend(bench_status(folders, args.workers, args.repeat))
+    results.extend(bench_discovery(folders, args.workers, args.repeat))
+    results.extend(bench_render(folders, args.repeat))
+    results.extend(bench_batch(folders, args.workers))
+
+    baseline = None
+    if args.baseline:
+      with open(args.baseline) as f:
+        baseline = json.load(f)
+    report(results, baseline)
+
+    if args.save_baseline:
+      with open(args.save_baseline, "w") as f:
+        json.dump({"args": vars(args), "results": results}, f, indent=2)
+  finally:
+    if not args.workspace:
+      shutil.rmtree(root)
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,225 @@
+# Minimal stand-in for the Sublime Text API, enough to drive the plugin
+# headless from the benchmark suite.
+
+import threading
+import time
+
+HIDDEN = 1
+PERSISTENT = 16
+DRAW_EMPTY = 32
+
+class Region(object):
+
+  def __init__(self, a, b=None):
+    self.a = a
+    self.b = a if b is None else b
+
+  def begin(self):
+    return min(self.a, self.b)
+
+  def end(self):
+    return max(self.a, self.b)
+
+  def size(self):
+    return self.end() - self.begin()
+
+  def empty(self):
+    return self.a == self.b
+
+  def __eq__(self, other):
+    return isinstance(other, Region) and self.a == other.a and self.b == other.b
+
+  def __ne__(self, other):
+    return not self == other
+
+  def __repr__(self):
+    return "Region(%d, %d)" % (self.a, self.b)
+
+class Settings(object):
+
+  def __init__(self, values=None):
+    self.values = dict(values or {})
+
+  def get(self, key, default=None):
+    return self.values.get(key, default)
+
+  def set(self, key, value):
+    self.values[key] = value
+
+_SETTINGS = {}
+
+def load_settings(name):
+  if not name in _SETTINGS:
+    _SETTINGS[name] = Settings()
+  return _SETTINGS[name]
+
+class Selection(list):
+
+  def clear(self):
+    del self[:]
+
+  def add(self, region):
+    self.append(region)
+
+_ids = [0]
+
+def _next_id():
+  _ids[0] += 1
+  return _ids[0]
+
+class View(object):
+
+  def __init__(self, name=""):
+    self._id = _next_id()
+    self._name = name
+    self.text = u""
+    self.regions = {}
+    self._sel = Selection([Region(0)])
+    self._settings = Settings()
+    self.edits = 0
+
+  def id(self):
+    return self._id
+
+  def name(self):
+    return self._name
+
+  def set_name(self, name):
+    self._name = name
+
+  def settings(self):
+    return self._settings
+
+  def size(self):
+    return len(self.text)
+
+  def sel(self):
+    return self._sel
+
+  def begin_edit(self, *args):
+    return object()
+
+  def end_edit(self, edit):
+    pass
+
+  def set_read_only(self, value):
+    pass
+
+  def set_scratch(self, value):
+    pass
+
+  def show(self, pos):
+    pass
+
+  def file_name(self):
+    return None
+
+  def line(self, pos):
+    if isinstance(pos, Region):
+      pos = pos.begin()
+    begin = self.text.rfind(u"\n", 0, pos) + 1
+    end = self.text.find(u"\n", pos)
+    return Region(begin, len(self.text) if end < 0 else end)
+
+  def set_syntax_file(self, path):
+    pass
+
+  def substr(self, region):
+    if isinstance(region, Region):
+      return self.text[region.begin():region.end()]
+    return self.text[region:region + 1]
+
+  def insert(self, edit, pos, text):
+    self.edits += 1
+    self.text = self.text[:pos] + text + self.text[pos:]
+    return len(text)
+
+  def erase(self, edit, region):
+    self.edits += 1
+    self.text = self.text[:region.begin()] + self.text[region.end():]
+
+  def replace(self, edit, region, text):
+    self.edits += 1
+    self.text = self.text[:region.begin()] + text + self.text[region.end():]
+
+  def find(self, pattern, start):
+    idx = self.text.find(pattern, start)
+    if idx < 0:
+      return None
+    return Region(idx, idx + len(pattern))
+
+  def add_regions(self, key, regions, *args):
+    self.regions[key] = list(regions)
+
+  def get_regions(self, key):
+    return self.regions.get(key, [])
+
+  def erase_regions(self, key):
+    self.regions.pop(key, None)
+
+class Window(object):
+
+  def __init__(self, folders=None):
+    self._id = _next_id()
+    self._folders = list(folders or [])
+    self._views = []
+    self.panels = {}
+    self.commands = []
+
+  def id(self):
+    return self._id
+
+  def folders(self):
+    return self._folders
+
+  def views(self):
+    return self._views
+
+  def new_file(self):
+    view = View()
+    self._views.append(view)
+    return view
+
+  def focus_view(self, view):
+    pass
+
+  def active_view(self):
+    return None
+
+  def open_file(self, path):
+    self.commands.append(("open_file", path))
+
+  def get_output_panel(self, name):
+    if not name in self.panels:
+      self.panels[name] = View(name)
+    return self.panels[name]
+
+  def run_command(self, cmd, args=None):
+    self.commands.append((cmd, args))
+
+def status_message(message):
+  pass
+
+_timeouts = []
+_timeouts_lock = threading.Lock()
+
+def set_timeout(callback, delay):
+  with _timeouts_lock:
+    _timeouts.append((time.time() + delay / 1000.0, callback))
+
+def run_until(condition, timeout=60):
+  """Runs scheduled callbacks on the calling thread until `condition()` holds."""
+  end = time.time() + timeout
+  while not condition():
+    if time.time() > end:
+      raise RuntimeError("timed out waiting for the plugin")
+    now = time.time()
+    with _timeouts_lock:
+      ready = [entry for entry in _timeouts if entry[0] <= now]
+      for entry in ready:
+        _timeouts.remove(entry)
+    ready.sort(key=lambda entry: entry[0])
+    for when, callback in ready:
+      callback()
+    if not ready:
+      time.sleep(0.001)
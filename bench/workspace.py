@@ -0,0 +1,100 @@
+"""Generates synthetic multi-repository workspaces for the benchmarks.
+
+A workspace has `repos` top level modules. Each module is a git repository
+with a bare repository as `origin` and a tree of git backed dependencies in
+node_modules, declared in package.json the way our projects do it. Modules
+are put into dirty, untracked, stashed, ahead and behind states at the given
+rates.
+"""
+
+import json
+import os
+import random
+import subprocess
+
+GIT_ENV = dict(os.environ,
+  GIT_AUTHOR_NAME="bench", GIT_AUTHOR_EMAIL="bench@example.com",
+  GIT_COMMITTER_NAME="bench", GIT_COMMITTER_EMAIL="bench@example.com")
+
+def git(folder, *args):
+  subprocess.check_call(["git"] + list(args), cwd=folder, env=GIT_ENV,
+    stdout=open(os.devnull, "w"), stderr=subprocess.STDOUT)
+
+def write(path, content):
+  with open(path, "w") as f:
+    f.write(content)
+
+def commit_all(folder, message):
+  git(folder, "add", "-A")
+  git(folder, "commit", "-q", "-m", message)
+
+def create_module(folder, name, deps, files):
+  os.makedirs(folder)
+  git(folder, "init", "-q")
+  git(folder, "symbolic-ref", "HEAD", "refs/heads/master")
+  package = {"name": name, "dependencies": {}}
+  for dep in deps:
+    package["dependencies"][dep] = "substance/%s" % dep
+  write(os.path.join(folder, "package.json"), json.dumps(package, indent=2))
+  write(os.path.join(folder, ".gitignore"), "node_modules\n")
+  for i in range(files):
+    write(os.path.join(folder, "file%d.txt" % i), "%s %d\n" % (name, i))
+  commit_all(folder, "initial")
+
+def create_dependencies(folder, name, level, depth, deps, files):
+  if level >= depth:
+    return 0
+  count = 0
+  names = ["%s-d%d" % (name, i) for i in range(deps)]
+  for dep in names:
+    dep_folder = os.path.join(folder, "node_modules", dep)
+    child_deps = ["%s-d%d" % (dep, i) for i in range(deps)] if level + 1 < depth else []
+    create_module(dep_folder, dep, child_deps, files)
+    count += 1 + create_dependencies(dep_folder, dep, level + 1, depth, deps, files)
+  return count
+
+def generate(root, repos=10, depth=1, deps=2, files=20, dirty=0.3, untracked=0.3,
+    stash=0.1, ahead=0.2, behind=0.2, seed=0):
+  """Creates the workspace below `root` and returns a description of it."""
+  rnd = random.Random(seed)
+  workspace = os.path.join(root, "workspace")
+  remotes = os.path.join(root, "remotes")
+  os.makedirs(workspace)
+  os.makedirs(remotes)
+
+  folders = []
+  total = 0
+  for idx in range(repos):
+    name = "module%d" % idx
+    folder = os.path.join(workspace, name)
+    top_deps = ["%s-d%d" % (name, i) for i in range(deps)] if depth > 0 else []
+    create_module(folder, name, top_deps, files)
+    total += 1 + create_dependencies(folder, name, 0, depth, deps, files)
+
+    remote = os.path.join(remotes, name + ".git")
+    git(root, "clone", "-q", "--bare", folder, remote)
+    git(folder, "remote", "add", "origin", remote)
+    git(folder, "fetch", "-q", "origin")
+    git(folder, "branch", "-q", "--set-upstream-to=origin/master")
+
+    if rnd.random() < behind:
+      write(os.path.join(folder, "file0.txt"), "upstream change\n")
+      commit_all(folder, "upstream")
+      git(folder, "push", "-q", "origin", "master")
+      git(folder, "reset", "-q", "--hard", "HEAD~1")
+    if rnd.random() < ahead:
+      write(os.path.join(folder, "local.txt"), "local change\n")
+      commit_all(folder, "local")
+    if rnd.random() < stash:
+      write(os.path.join(folder, "file1.txt"), "stashed change\n")
+      git(folder, "stash", "-q")
+    if rnd.random() < dirty:
+      for i in range(0, files, 3):
+        write(os.path.join(folder, "file%d.txt" % i), "dirty\n")
+    if rnd.random() < untracked:
+      os.makedirs(os.path.join(folder, "generated"))
+      for i in range(files):
+        write(os.path.join(folder, "generated", "out%d.txt" % i), "generated\n")
+    folders.append(folder)
+
+  return {"root": root, "folders": folders, "repositories": total}
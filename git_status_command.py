@@ -2,14 +2,215 @@ import sublime, sublime_plugin
 import subprocess
 import os
 import time
-import re
-from utils import read_project_config
-from gitstatus import gitstatus
+import threading
+import functools
+import bisect
+import tempfile
+import traceback
+from utils import load_project_index, parallel_map, fetch_all
+from gitstatus import StatusCache, StatusStore, DiffCache, GitTimeoutError, RepoStatus, UNTRACKED_MODES
+from tracing import TRACER, TracedPopen
+from watcher import RepoWatcher
 
 PACKAGE_SETTINGS = "SubstanceGit.sublime-settings"
 
 MANAGERS = {}
+# status results shared by all managers
+STORE = None
 NAME = ".Git.Status"
+DIFF_PANEL = "git_diff"
+TIMED_OUT = "(timed out)"
+FAILED = "(status failed, see the console)"
+CHECKING = "(checking...)"
+
+def to_text(s):
+  if isinstance(s, bytes):
+    return s.decode('utf-8', 'replace')
+  return s
+
+STATUS_WORDS = {'M': 'modified', 'A': 'new', 'D': 'deleted', 'R': 'renamed', 'C': 'copied', 'T': 'typechange'}
+CONFLICT_WORDS = {'DD': 'both deleted', 'AU': 'added by us', 'UD': 'deleted by them', 'UA': 'added by them',
+  'DU': 'deleted by us', 'AA': 'both added', 'UU': 'both modified'}
+
+def _plural(count, word):
+  if count == 1:
+    return "%d %s"%(count, word)
+  return "%d %ss"%(count, word)
+
+def format_branch(status):
+  lines = []
+  if status.detached:
+    lines.append("HEAD detached at %s"%status.branch)
+  else:
+    lines.append("On branch %s"%status.branch)
+  if status.upstream:
+    if status.ahead and status.behind:
+      lines.append("Your branch and '%s' have diverged (%d and %d commits)."%(status.upstream, status.ahead, status.behind))
+    elif status.ahead:
+      lines.append("Your branch is ahead of '%s' by %s."%(status.upstream, _plural(status.ahead, "commit")))
+    elif status.behind:
+      lines.append("Your branch is behind '%s' by %s."%(status.upstream, _plural(status.behind, "commit")))
+  return lines
+
+def format_branches(status, diverged_only):
+  branches = status.branches or []
+  if diverged_only:
+    branches = [branch for branch in branches if branch.diverged]
+  if len(branches) == 0:
+    return []
+  lines = ["", "Branches:"]
+  for branch in branches:
+    if branch.upstream == None:
+      track = "no upstream"
+    elif branch.gone:
+      track = "%s is gone"%branch.upstream
+    elif branch.ahead or branch.behind:
+      track = "%s: ahead %d, behind %d"%(branch.upstream, branch.ahead, branch.behind)
+    else:
+      track = "%s: up to date"%branch.upstream
+    lines.append("  %s %s (%s)"%("*" if branch.current else " ", branch.name, track))
+  return lines
+
+def _file_line(word, entry):
+  path = entry.path
+  if entry.orig_path:
+    path = "%s -> %s"%(entry.orig_path, entry.path)
+  return "  %-12s%s"%(word + ":", path)
+
+def _entry_lines(entry):
+  # every line `entry` is shown as, in the short and the long mode
+  words = ["new", STATUS_WORDS.get(entry.index, entry.index), STATUS_WORDS.get(entry.worktree, entry.worktree)]
+  if entry.conflicted:
+    words.append(CONFLICT_WORDS[entry.index + entry.worktree])
+  return [entry.short()] + [_file_line(word, entry) for word in words]
+
+def _more_line(hidden):
+  return ["", "... and %d more"%hidden]
+
+def format_summary(status):
+  """One line with the branch and the number of files per section; None for clean and synced repos."""
+  diverged = len([branch for branch in status.branches or [] if branch.diverged])
+  if status.clean and status.synced and diverged == 0:
+    return None
+  if status.detached:
+    line = "HEAD detached at %s"%status.branch
+  else:
+    line = "On branch %s"%status.branch
+  tracking = []
+  if status.ahead:
+    tracking.append("ahead %d"%status.ahead)
+  if status.behind:
+    tracking.append("behind %d"%status.behind)
+  if tracking:
+    line += " (%s)"%", ".join(tracking)
+  counts = []
+  conflicts = len([entry for entry in status.entries if entry.conflicted])
+  if conflicts:
+    counts.append(_plural(conflicts, "conflict"))
+  for word, count in [("staged", len([entry for entry in status.entries if entry.staged])),
+      ("changed", len([entry for entry in status.entries if entry.changed])),
+      ("untracked", len([entry for entry in status.entries if entry.untracked]))]:
+    if count:
+      counts.append("%d %s"%(count, word))
+  if diverged:
+    counts.append("%d diverged branch%s"%(diverged, "" if diverged == 1 else "es"))
+  if counts:
+    line += ": %s"%", ".join(counts)
+  return line
+
+def format_short(status, limit=None):
+  """Branch, tracking and changed files by section; None for clean and synced repos.
+
+  At most `limit` file lines are listed.
+  """
+  branches = format_branches(status, True)
+  if status.clean and status.synced and len(branches) == 0:
+    return None
+  lines = format_branch(status)
+  lines.extend(branches)
+  conflicts = [entry for entry in status.entries if entry.conflicted]
+  staged = [entry for entry in status.entries if entry.staged]
+  changed = [entry for entry in status.entries if entry.changed]
+  untracked = [entry for entry in status.entries if entry.untracked]
+  sections = [
+    ("Conflicts:", [_file_line(CONFLICT_WORDS[entry.index + entry.worktree], entry) for entry in conflicts]),
+    ("Staged:", [_file_line(STATUS_WORDS.get(entry.index, entry.index), entry) for entry in staged]),
+    ("Unstaged:", [_file_line(STATUS_WORDS.get(entry.worktree, entry.worktree), entry) for entry in changed]),
+    (None, [_file_line("new", entry) for entry in untracked])
+  ]
+  shown = 0
+  total = 0
+  for title, files in sections:
+    total += len(files)
+    if len(files) == 0 or (limit != None and shown >= limit):
+      continue
+    if title != None:
+      lines.extend(["", title])
+    elif not changed:
+      lines.append("")
+    if limit != None:
+      files = files[:limit - shown]
+    lines.extend(files)
+    shown += len(files)
+  if shown < total:
+    lines.extend(_more_line(total - shown))
+  return "\n".join(lines)
+
+def format_long(status, limit=None):
+  """Sha, branch and stashes followed by `git status -s` like lines, for every repo.
+
+  At most `limit` file lines are listed.
+  """
+  lines = ["sha: %s"%status.sha, ""]
+  lines.extend(format_branch(status))
+  if status.stashed:
+    lines.append("Stashes: %d"%status.stashed)
+  lines.append("git status took %.0f ms"%(status.elapsed * 1000))
+  lines.extend(format_branches(status, False))
+  lines.append("")
+  if status.clean:
+    lines.append("nothing to commit, working tree clean")
+  else:
+    entries = status.entries
+    if limit != None:
+      entries = entries[:limit]
+    lines.extend([entry.short() for entry in entries])
+    if len(entries) < len(status.entries):
+      lines.extend(_more_line(len(status.entries) - len(entries)))
+  return "\n".join(lines)
+
+def shared_store(settings):
+  global STORE
+  if STORE == None:
+    STORE = StatusStore(StatusCache(settings.get('status_cache_size', 256), settings.get('status_cache_max_age', 5)),
+      DiffCache(settings.get('diff_cache_chars', 2**22)))
+  return STORE
+
+def status_options(options, folder):
+  """Returns the untracked mode and git config of `folder` for `git status`.
+
+  "repo_settings" may override the global settings by folder path or name.
+  """
+  repo_settings = options["repo_settings"]
+  overrides = repo_settings.get(folder) or repo_settings.get(os.path.basename(folder)) or {}
+  untracked = overrides.get("untracked_mode", options["untracked"])
+  if untracked != None and not untracked in UNTRACKED_MODES:
+    print("Unknown untracked_mode %s for %s"%(untracked, folder))
+    untracked = None
+  config = []
+  if overrides.get("untracked_cache", options["untracked_cache"]):
+    config.append("core.untrackedCache=true")
+  if overrides.get("fsmonitor", options["fsmonitor"]):
+    config.append("core.fsmonitor=true")
+  return untracked, tuple(config)
+
+def describe_options(untracked, config):
+  parts = ["untracked %s"%(untracked or "default")]
+  if "core.untrackedCache=true" in config:
+    parts.append("untracked cache")
+  if "core.fsmonitor=true" in config:
+    parts.append("fsmonitor")
+  return ", ".join(parts)
 
 class GitStatusManager():
 
@@ -18,138 +219,525 @@ class GitStatusManager():
     self.view = view
     self.short = True
     self.settings = sublime.load_settings(PACKAGE_SETTINGS)
-    self.entries = []
-
-  def parse_status_message(self, message):
-    output = []
-
-    state = "top"
-
-    PREFIX = '#?\s*'
-    RE_STAGED_CHANGES = re.compile('^%sChanges to be committed.*$'%PREFIX)
-    RE_UNSTAGED_CHANGES = re.compile('^%sChanges not staged.*$'%PREFIX)
-    RE_UNTRACKED_FILES = re.compile('^%sUntracked files.*$'%PREFIX)
-    RE_WS = re.compile('^%s$'%PREFIX)
-    RE_COMMENT = re.compile('^%s\(.+$'%PREFIX)
-    RE_COMMENT2 = re.compile('^%sno changes added to commit'%PREFIX)
-    RE_STRIP_PREFIX = re.compile('^%s(.*)$'%PREFIX)
-
-    for line in message.splitlines():
-      if RE_WS.match(line):
-        continue
-      if RE_STAGED_CHANGES.match(line):
-        state = "staged"
-        output.append("")
-        output.append("Staged:")
-        continue
-      if RE_UNSTAGED_CHANGES.match(line):
-        state = "unstaged"
-        output.append("")
-        output.append("Unstaged:")
-        continue
-      if RE_UNTRACKED_FILES.match(line):
-        state = "untracked"
-        continue
-      if RE_COMMENT.match(line) or RE_COMMENT2.match(line):
-        continue
-
-      stripped = line;
-      m = RE_STRIP_PREFIX.match(line)
-      if m:
-        stripped = m.group(1)
-
-      if state == "top":
-        output.append(stripped)
-      elif state == "untracked":
-        output.append("  new:        %s"%stripped)
-      else:
-        output.append("  "+stripped)
-
-    return '\n'.join(output)
-
-  def get_status_for_folder(self, folder):
+    self.show_branches = self.settings.get('show_branches', False)
+    # in the short mode repos show a summary until they are expanded;
+    # expanded repos map to the number of file list pages shown
+    self.collapsed = self.settings.get('status_collapsed', True)
+    self.page_size = self.settings.get('status_page_size', 100)
+    self.expanded = {}
+    self.block_starts = []
+    self.block_folders = []
+    self.blocks = []
+    self.store = shared_store(self.settings)
+    self.running = False
+    self.running_full = False
+    self.pending = False
+    self.pending_force = False
+    self.pending_folders = None
+    self.scheduled = False
+    self.last_refresh = 0
+    self.results = {}
+    self.watcher = None
+    self.fetching = False
+    # results of the running refresh waiting to be rendered
+    self.incoming = []
+    self.incoming_lock = threading.Lock()
+    self.flush_scheduled = False
+    self.checking = set()
+    self.progress = None
+    # the last full refresh failed before all repos were checked
+    self.collect_failed = False
+    # total `git status` time of the last full refresh, and of the one
+    # before the status options changed
+    self.timing = None
+    self.timing_before = None
+
+  def get_status_for_folder(self, folder, git_command, porcelain, deadline=None, untracked=None, config=(), branches=False):
+    """Returns the RepoStatus of `folder`, TIMED_OUT, FAILED or None if it is no repository."""
     try:
-      git_command = self.settings.get('git_command')
-      stat = gitstatus(folder, git_command=git_command, plain_only=True)
+      stat = self.store.status(folder, git_command=git_command, porcelain=porcelain, deadline=deadline,
+        untracked=untracked, config=config, source=self)
       if not stat:
         return None
-      if self.short:
-        stat['status'] = self.parse_status_message(stat['status']).strip()
-
-      if stat['status'] == "" or stat['status'] == None:
-        return None
-
-      if self.short and 'nothing to commit' in stat['status'] and not 'Your branch is ahead' in stat['status'] and not 'Your branch is behind' in stat['status'] and not 'have diverged' in stat['status']:
-        return None
-      elif self.short:
-        return [ folder, stat['status'] ]
-      else:
-        return [ folder, "sha: %s\n\n%s"%(stat['sha'], stat['status']) ]
-
+      status = RepoStatus(folder, stat)
+      if branches:
+        status.branches = self.store.branches(folder, git_command, deadline)
+      return status
+
+    except GitTimeoutError:
+      print("Git status timed out in %s"%folder)
+      return TIMED_OUT
     except OSError as err:
       print(err)
+      return FAILED
+
+  def format(self, result):
+    """Returns the text shown for a result in the current mode, None hides it."""
+    if result == None or result == TIMED_OUT or result == FAILED:
+      return result
+    if self.short and self.collapsed and not result.folder in self.expanded:
+      return format_summary(result)
+    limit = None
+    if self.page_size:
+      limit = self.page_size * self.expanded.get(result.folder, 1)
+    if self.short:
+      return format_short(result, limit)
+    return format_long(result, limit)
+
+  def expand(self, folders, more=False):
+    """Expands or collapses the file lists of `folders`, or shows one more page of them."""
+    for folder in folders:
+      if more:
+        shown = self.expanded.get(folder, 0 if self.short and self.collapsed else 1)
+        self.expanded[folder] = shown + 1
+      elif folder in self.expanded:
+        del self.expanded[folder]
+      else:
+        self.expanded[folder] = 1
+    self.render_results(self.window.folders())
+
+  def load_config(self):
+    """Returns the module index of every window folder as {folder: {"data": modules}}."""
+    git_command = self.settings.get('git_command')
+    workers = self.settings.get('status_workers', 8)
+    config = {}
+    for folder in self.window.folders():
+      if os.path.exists(os.path.join(folder, ".git")):
+        config[folder] = {"data": load_project_index(folder, git_command, workers)}
+    return config
+
+  def get_entry(self, pos):
+    idx = bisect.bisect_right(self.block_starts, pos.begin()) - 1
+    if idx < 0:
       return None
+    return self.block_folders[idx]
 
-  def process_top_folder(self, folder):
-    result = []
+  def get_entries(self, regions):
+    """Returns the folders touched by any of the given regions, in view order."""
+    folders = []
+    for region in regions:
+      first = max(bisect.bisect_right(self.block_starts, region.begin()) - 1, 0)
+      last = bisect.bisect_right(self.block_starts, max(region.end() - 1, region.begin()))
+      for folder in self.block_folders[first:last]:
+        if not folder in folders:
+          folders.append(folder)
+    return folders
 
-    git_folder = os.path.join(folder, ".git")
-    if os.path.exists(git_folder):
-      item = self.get_status_for_folder(folder)
-      if not item == None:
-        result.append(item)
+  def get_file(self, pos):
+    """Returns the RepoStatus and FileEntry of the file shown at `pos`, or None."""
+    folder = self.get_entry(pos)
+    status = self.results.get(folder)
+    if not isinstance(status, RepoStatus):
+      return None
+    line = self.view.substr(self.view.line(pos))
+    for entry in status.entries:
+      if line in _entry_lines(entry):
+        return status, entry
+    return None
 
-    return result
+  def show_diff(self, status, entry):
+    """Shows the diff of `entry` in an output panel; git runs on a worker thread."""
+    git_command = self.settings.get('git_command')
+    timeout = self.settings.get('git_timeout', 10)
+    max_chars = self.settings.get('diff_max_chars', 200000)
+    sublime.status_message("Git diff of %s"%entry.path)
+    def run():
+      deadline = time.time() + timeout if timeout else None
+      try:
+        text = self.store.diff(status.folder, entry, status.sha, git_command, deadline, max_chars)
+        if text == None:
+          text = u"git diff failed for %s\n"%entry.path
+        elif len(text) == 0:
+          text = u"No changes in %s\n"%entry.path
+      except GitTimeoutError:
+        text = u"git diff timed out for %s\n"%entry.path
+      except OSError as err:
+        text = u"%s\n"%err
+      sublime.set_timeout(functools.partial(self.on_diff, text), 0)
+    threading.Thread(target=run).start()
+
+  def on_diff(self, text):
+    if self.view == None:
+      return
+    panel = self.window.get_output_panel(DIFF_PANEL)
+    panel.set_read_only(False)
+    edit = panel.begin_edit()
+    panel.erase(edit, sublime.Region(0, panel.size()))
+    panel.insert(edit, 0, text)
+    panel.end_edit(edit)
+    panel.set_syntax_file("Packages/Diff/Diff.tmLanguage")
+    panel.set_read_only(True)
+    self.window.run_command("show_panel", {"panel": "output.%s"%DIFF_PANEL})
+
+  def update(self, force=False, folders=None):
+    """Schedules a refresh of the status view.
+
+    Git runs on a background thread. Requests arriving while a refresh is
+    running are merged into a single follow-up refresh, and refreshes are
+    spaced by at least `refresh_interval` milliseconds unless forced.
+    With `folders` only these repositories are checked again. Forced
+    refreshes bypass the status cache.
+    """
 
-  def get_entry(self, pos):
-    pos = pos.begin()
-    folder = None
+    if self.view == None:
+      return
 
-    for entry in self.entries:
-      folder = entry[1]
-      if (entry[0] > pos):
-        break
-    return folder
+    if self.running:
+      # an unforced full refresh is served by the full refresh already running
+      if not force and folders == None and self.running_full:
+        return
+      if not self.pending:
+        self.pending_folders = None if folders == None else set(folders)
+      elif self.pending_folders != None:
+        self.pending_folders = None if folders == None else self.pending_folders | set(folders)
+      self.pending = True
+      self.pending_force = self.pending_force or force
+      return
 
-  def update(self):
+    interval = self.settings.get('refresh_interval', 1000) / 1000.0
+    wait = self.last_refresh + interval - time.time()
+    if not force and folders == None and wait > 0:
+      if not self.scheduled:
+        self.scheduled = True
+        sublime.set_timeout(self.on_scheduled_update, int(wait * 1000))
+      return
 
+    self.running = True
+    self.running_full = folders == None
+    self.pending = False
+    self.pending_force = False
+    self.pending_folders = None
+
+    # settings are read here as the workers must not use the sublime API
+    options = {
+      "folders": self.window.folders(),
+      "only": None if folders == None else set(folders),
+      "git_command": self.settings.get('git_command'),
+      "porcelain": self.settings.get('status_porcelain', True),
+      "workers": self.settings.get('status_workers', 8),
+      "timeout": self.settings.get('git_timeout', 10),
+      "deadline": self.settings.get('refresh_deadline', 30),
+      "render_interval": self.settings.get('status_render_interval', 100),
+      "untracked": self.settings.get('untracked_mode', 'normal'),
+      "untracked_cache": self.settings.get('untracked_cache', False),
+      "fsmonitor": self.settings.get('fsmonitor', False),
+      "repo_settings": self.settings.get('repo_settings', {}),
+      "branches": self.show_branches,
+      "dirty": set([folder for folder, item in self.results.items() if self.format(item) != None]),
+      "known": set(self.results.keys()),
+      "refresh": TRACER.begin_refresh()
+    }
+    if folders == None:
+      self.store.subscribe(self, options["folders"])
+    if force:
+      # the fingerprints miss working tree edits, an explicit refresh runs git
+      for folder in options["only"] or options["folders"]:
+        self.store.invalidate(folder)
+    if self.settings.get('watch_repos', False) and self.watcher == None:
+      self.start_watcher(options["folders"])
+    threading.Thread(target=self.collect, args=(options,)).start()
+
+  def on_scheduled_update(self):
+    self.scheduled = False
+    self.update()
+
+  def start_watcher(self, folders):
+    repos = [folder for folder in folders if os.path.exists(os.path.join(folder, ".git"))]
+    self.watcher = RepoWatcher(self.on_repos_changed_async,
+      max_watches=self.settings.get('watch_max_descriptors', 4096))
+    self.watcher.start(repos)
+
+  def on_repos_changed_async(self, repos):
+    # called on the watcher thread
+    sublime.set_timeout(functools.partial(self.on_repos_changed, repos), 0)
+
+  def on_repos_changed(self, repos):
+    for repo in repos:
+      self.store.invalidate(repo)
+    self.update(folders=repos)
+
+  def on_shared_status(self, real_path):
+    # another view got a new result for a repository shown here
+    sublime.set_timeout(functools.partial(self.on_shared_changed, real_path), 0)
+
+  def on_shared_changed(self, real_path):
     if self.view == None:
       return
+    folders = [folder for folder in self.window.folders() if os.path.realpath(folder) == real_path]
+    if len(folders) > 0:
+      self.update(folders=folders)
+
+  def fetch(self):
+    """Fetches the remotes of all modules in the background.
+
+    Each repository shown in the view is checked again as soon as its own
+    fetch completed, so that ahead/behind counts show up one by one.
+    """
+    if self.fetching:
+      sublime.status_message("Git fetch is already running")
+      return
+    repos = []
+    for top_folder, entry in self.load_config().items():
+      repos.extend(entry["data"].values())
+    if len(repos) == 0:
+      return
+    self.fetching = True
+    options = {
+      "git_command": self.settings.get('git_command'),
+      "workers": self.settings.get('fetch_workers', 4),
+      "timeout": self.settings.get('fetch_timeout', 60)
+    }
+    threading.Thread(target=self.run_fetch, args=(repos, options)).start()
+
+  def run_fetch(self, repos, options):
+    results = []
+    progress = {"done": 0}
+    lock = threading.Lock()
+
+    def on_fetched(paths, result):
+      with lock:
+        progress["done"] += 1
+        done = progress["done"]
+      sublime.set_timeout(functools.partial(self.on_fetched, paths, result, done), 0)
+
+    try:
+      with TRACER.span("fetch_all", repos=len(repos)):
+        results = fetch_all(repos, options["git_command"], options["workers"], options["timeout"], on_fetched)
+    finally:
+      sublime.set_timeout(functools.partial(self.on_fetch_finished, results), 0)
+
+  def on_fetched(self, paths, result, done):
+    sublime.status_message("Git fetch: %d remotes done"%done)
+    if not result["ok"]:
+      return
+    for path in paths:
+      self.store.invalidate(path)
+    if self.view != None:
+      shown = [path for path in paths if path in self.window.folders()]
+      if len(shown) > 0:
+        self.update(folders=shown)
+
+  def on_fetch_finished(self, results):
+    self.fetching = False
+    failed = [(paths, result) for paths, result in results if not result["ok"]]
+    for paths, result in failed:
+      reason = "timed out" if result["timed_out"] else result["error"]
+      print("Git fetch failed in %s: %s"%(paths[0], reason))
+    if len(failed) > 0:
+      sublime.status_message("Git fetch: %d of %d remotes failed (see console)"%(len(failed), len(results)))
+    else:
+      sublime.status_message("Git fetch: %d remotes up to date"%len(results))
+
+  def close(self):
+    if self.watcher != None:
+      self.watcher.stop()
+      self.watcher = None
+    # drops the shared results of repositories no other view shows
+    self.store.unsubscribe(self)
+    self.results = {}
+    self.blocks = []
+    self.view = None
+
+  def collect(self, options):
+    items = []
+    collected = False
+    refresh = options["refresh"]
+    options["cache_stats"] = self.store.cache.stats()
+    try:
+      git_command = options["git_command"]
+      porcelain = options["porcelain"]
+      # a repo gets `timeout` seconds, but none runs past the refresh deadline
+      refresh_deadline = None
+      if options["deadline"]:
+        refresh_deadline = time.time() + options["deadline"]
+
+      def process(folder):
+        deadline = refresh_deadline
+        if options["timeout"]:
+          repo_deadline = time.time() + options["timeout"]
+          if deadline == None or repo_deadline < deadline:
+            deadline = repo_deadline
+        if deadline != None and deadline <= time.time():
+          return TIMED_OUT
+        try:
+          untracked, config = status_options(options, folder)
+          item = self.get_status_for_folder(folder, git_command, porcelain, deadline, untracked, config, options["branches"])
+        except Exception:
+          # a broken repo must not show up as a clean one
+          print("Git status failed in %s"%folder)
+          traceback.print_exc()
+          item = FAILED
+        self.post_result(options, folder, item)
+        return item
+
+      with TRACER.span("discovery") as span:
+        folders = [folder for folder in options["folders"] if os.path.exists(os.path.join(folder, ".git"))]
+        if options["only"] != None:
+          folders = [folder for folder in folders if folder in options["only"]]
+      refresh["phases"]["discovery"] = span.duration
+      sublime.set_timeout(functools.partial(self.on_collect_started, options, folders), 0)
+
+      # repos which were dirty before, then new ones, are the most likely to show up
+      def priority(folder):
+        if folder in options["dirty"]:
+          return 0
+        if not folder in options["known"]:
+          return 1
+        return 2
+      ordered = sorted(folders, key=priority)
+
+      with TRACER.span("collection", repos=len(folders)) as span:
+        items = list(zip(ordered, parallel_map(process, ordered, options["workers"])))
+      refresh["phases"]["collection"] = span.duration
+      collected = True
+    finally:
+      sublime.set_timeout(functools.partial(self.on_collected, options, items, refresh, collected), 0)
+
+  def post_result(self, options, folder, item):
+    # called on the workers, results are rendered in batches
+    with self.incoming_lock:
+      self.incoming.append((folder, item))
+      if self.flush_scheduled:
+        return
+      self.flush_scheduled = True
+    sublime.set_timeout(functools.partial(self.flush_results, options), options["render_interval"])
+
+  def take_incoming(self):
+    with self.incoming_lock:
+      items = self.incoming
+      self.incoming = []
+      self.flush_scheduled = False
+    return items
+
+  def on_collect_started(self, options, folders):
+    # a full refresh shows a section for every repo which was not seen before
+    if options["only"] != None:
+      return
+    self.checking = set(folders)
+    self.progress = {"checked": 0, "total": len(folders)}
+    self.render_results(options["folders"], options["refresh"])
 
+  def flush_results(self, options):
+    items = self.take_incoming()
+    if len(items) == 0 or self.progress == None:
+      return
+    for folder, item in items:
+      self.results[folder] = item
+      self.checking.discard(folder)
+    self.progress["checked"] += len(items)
+    self.render_results(options["folders"], options["refresh"])
+
+  def render_results(self, folders, refresh=None):
+    """Renders the known results; git is not run again."""
+    # the view may have been closed in the meantime
+    if self.view == None:
+      return
+    changes = []
+    for folder in folders:
+      if folder in self.checking and not folder in self.results:
+        changes.append((folder, CHECKING))
+        continue
+      text = self.format(self.results.get(folder))
+      if text != None:
+        changes.append((folder, text))
+    with TRACER.span("rendering") as span:
+      self.render(changes, self.progress)
+    if refresh != None:
+      refresh["phases"]["rendering"] = refresh["phases"].get("rendering", 0) + span.duration
+
+  def on_collected(self, options, items, refresh, collected=True):
+    # cache use during this refresh, for the performance report
+    stats = self.store.cache.stats()
+    refresh["cache"] = dict([(key, stats[key] - options["cache_stats"][key]) for key in ("hits", "misses", "evictions")])
+    try:
+      # everything still waiting is part of `items`
+      self.take_incoming()
+      self.checking = set()
+      self.progress = None
+      for folder, item in items:
+        self.results[folder] = item
+      if options["only"] == None:
+        # if the collection failed as a whole the previous results are kept
+        self.collect_failed = not collected
+        if collected:
+          # forget repos which are gone
+          checked = set([folder for folder, item in items])
+          for folder in list(self.results.keys()):
+            if not folder in checked:
+              del self.results[folder]
+              self.expanded.pop(folder, None)
+          self.record_timing(options)
+      self.render_results(options["folders"], refresh)
+    finally:
+      TRACER.end_refresh(refresh)
+      self.running = False
+      self.last_refresh = time.time()
+    if self.pending:
+      self.update(force=self.pending_force, folders=self.pending_folders)
+
+  def record_timing(self, options):
+    # only results git computed during this refresh, cache hits carry old timings
+    start = options["refresh"]["start"]
+    statuses = []
+    labels = set()
+    for folder, result in self.results.items():
+      if isinstance(result, RepoStatus) and result.checked != None and result.checked >= start:
+        statuses.append(result)
+        labels.add(describe_options(*status_options(options, folder)))
+    if len(statuses) == 0:
+      return
+    timing = {
+      "label": labels.pop() if len(labels) == 1 else "mixed settings",
+      "total": sum([status.elapsed for status in statuses]),
+      "repos": len(statuses),
+      "tuned": (options["untracked_cache"] or options["fsmonitor"] or len(options["repo_settings"]) > 0
+        or options["untracked"] != "normal")
+    }
+    if self.timing != None and self.timing["label"] != timing["label"]:
+      self.timing_before = self.timing
+    self.timing = timing
+
+  def timing_header(self):
+    """Returns the `git status` timings, shown once non default status options are used."""
+    timing = self.timing
+    if timing == None or (not timing["tuned"] and self.timing_before == None):
+      return None
+    header = u"git status: %.0f ms in %d repos (%s)"%(timing["total"] * 1000, timing["repos"], timing["label"])
+    before = self.timing_before
+    if before != None:
+      header += u"; before: %.0f ms in %d repos (%s)"%(before["total"] * 1000, before["repos"], before["label"])
+    return header + u"\n\n"
+
+  def render(self, changes, progress=None):
+    """Shows `changes`, a list of (folder, output) pairs, in the view.
+
+    While a refresh is running, `progress` holds the number of checked and
+    the total number of repositories.
+    """
     view = self.view
 
     sel = view.sel()
     oldPos = sel[0]
 
-    self.window.focus_view(self.view)
-
-    changes = []
-    for folder in self.window.folders():
-      changes.extend(self.process_top_folder(folder))
+    # blocks which do not belong to a folder have tuple keys
+    blocks = []
+    header = self.timing_header()
+    if header != None:
+      blocks.append((("timing",), header))
+    if progress != None:
+      blocks.append((("progress",), u"%d of %d repos checked\n\n"%(progress["checked"], progress["total"])))
+    if len(changes) == 0 and progress == None:
+      if self.collect_failed:
+        blocks.append((("message",), u"Git status failed, see the console.\n"))
+      else:
+        blocks.append((("message",), u"Everything committed. Yeaah!\n"))
+    else:
+      blocks.extend([(folder, u"- %s:\n\n%s\n\n"%(folder, to_text(output))) for folder, output in changes])
 
     # begin edit for adding content
     view.set_read_only(False)
     edit = view.begin_edit()
-
-    self.entries = []
-
-    # erase existent content
-    all = sublime.Region(0, view.size()+1)
-    view.erase(edit, all)
-
-    if len(changes) == 0:
-      view.insert(edit, view.size(), "Everything committed. Yeaah!\n")
-
-    else:
-
-      for folder, output in changes:
-        entry = {"folder": folder}
-        view.insert(edit, view.size(), "- %s:\n"%(folder))
-        view.insert(edit, view.size(), "\n")
-        view.insert(edit, view.size(), "%s\n"%output)
-        view.insert(edit, view.size(), "\n")
-        self.entries.append([view.size(), folder])
-
+    self.replace_blocks(edit, blocks)
     view.end_edit(edit)
 
     # freeze the file
@@ -160,6 +748,65 @@ class GitStatusManager():
     view.sel().add(oldPos)
     view.show(oldPos)
 
+  def replace_blocks(self, edit, blocks):
+    """Brings the view from the currently shown blocks to `blocks`.
+
+    Blocks are (folder, text) pairs. Only blocks which have been added, removed
+    or whose text changed are touched, so folds and unchanged content survive.
+    """
+    view = self.view
+    old = self.blocks
+    old_keys = set([key for key, text in old])
+    new_keys = set([key for key, text in blocks])
+
+    same_order = ([key for key, text in old if key in new_keys]
+      == [key for key, text in blocks if key in old_keys])
+    if not same_order or view.size() != sum([len(text) for key, text in old]):
+      view.erase(edit, sublime.Region(0, view.size()))
+      view.insert(edit, 0, u"".join([text for key, text in blocks]))
+    else:
+      # collect the edits in old coordinates and apply them back to front
+      ops = []
+      offset = 0
+      idx = 0
+      for key, text in blocks:
+        while idx < len(old) and not old[idx][0] in new_keys:
+          ops.append((offset, offset + len(old[idx][1]), u""))
+          offset += len(old[idx][1])
+          idx += 1
+        if key in old_keys:
+          old_text = old[idx][1]
+          if old_text != text:
+            ops.append((offset, offset + len(old_text), text))
+          offset += len(old_text)
+          idx += 1
+        else:
+          ops.append((offset, offset, text))
+      while idx < len(old):
+        ops.append((offset, offset + len(old[idx][1]), u""))
+        offset += len(old[idx][1])
+        idx += 1
+      for begin, end, text in reversed(ops):
+        if begin == end:
+          view.insert(edit, begin, text)
+        elif text:
+          view.replace(edit, sublime.Region(begin, end), text)
+        else:
+          view.erase(edit, sublime.Region(begin, end))
+
+    # keep a sorted index of block offsets for cursor lookups
+    self.block_starts = []
+    self.block_folders = []
+    offset = 0
+    for key, text in blocks:
+      begin = offset
+      offset += len(text)
+      if isinstance(key, tuple):
+        continue
+      self.block_starts.append(begin)
+      self.block_folders.append(key)
+    self.blocks = blocks
+
 class GitStatusCommand(sublime_plugin.WindowCommand):
 
   def run(self):
@@ -177,7 +824,10 @@ class GitStatusCommand(sublime_plugin.WindowCommand):
     if not view.id() in MANAGERS:
       MANAGERS[view.id()] = GitStatusManager(window, view)
 
-    MANAGERS[view.id()].update()
+    # the refresh starts first, the update of on_activated is then served by it
+    MANAGERS[view.id()].update(force=True)
+    if window.active_view() != view:
+      window.focus_view(view)
 
 class GitGuiCommand(sublime_plugin.TextCommand):
 
@@ -192,15 +842,9 @@ class GitGuiCommand(sublime_plugin.TextCommand):
       return
     manager = MANAGERS[view.id()]
 
-    pos = view.sel()[0]
-    folder = manager.get_entry(pos)
-    if folder == None:
-      return
-
     cmd = self.settings.get("git_gui_command")
     # TODO: prepare command?
 
-    print("Running %s in %s"%(str(cmd), folder))
     startupinfo = None
     _env = os.environ.copy()
     if os.name == 'nt':
@@ -209,7 +853,10 @@ class GitGuiCommand(sublime_plugin.TextCommand):
     if os.name == 'posix':
       _env['PATH'] = "/usr/bin:/usr/local/bin:" + _env['PATH']
     print("OS NAME: %s"%(str(os.name)))
-    p = subprocess.Popen(cmd, cwd=folder, env=_env, startupinfo=startupinfo)
+
+    for folder in manager.get_entries(view.sel()):
+      print("Running %s in %s"%(str(cmd), folder))
+      p = TracedPopen(cmd, cwd=folder, env=_env, startupinfo=startupinfo)
 
 class GitLogCommand(sublime_plugin.TextCommand):
 
@@ -224,20 +871,17 @@ class GitLogCommand(sublime_plugin.TextCommand):
       return
     manager = MANAGERS[view.id()]
 
-    pos = view.sel()[0]
-    folder = manager.get_entry(pos)
-    if folder == None:
-      return
-
     cmd = self.settings.get("git_log_command")
     # TODO: prepare command?
 
-    print("Running %s in %s"%(str(cmd), folder))
     startupinfo = None
     if os.name == 'nt':
       startupinfo = subprocess.STARTUPINFO()
       startupinfo.dwFlags |= subprocess.STARTF_USESHOWWINDOW
-    p = subprocess.Popen(cmd, cwd=folder, shell=True, startupinfo=startupinfo)
+
+    for folder in manager.get_entries(view.sel()):
+      print("Running %s in %s"%(str(cmd), folder))
+      p = TracedPopen(cmd, cwd=folder, shell=True, startupinfo=startupinfo)
 
 class GitCommand(sublime_plugin.TextCommand):
 
@@ -259,7 +903,8 @@ class GitCommand(sublime_plugin.TextCommand):
       commands.append({"cmd": git_command, "working_dir": folder})
 
     self.view.window().run_command("batch_exec", {
-      "commands": commands
+      "commands": commands,
+      "max_parallel": self.settings.get("batch_max_parallel", 8)
       #"callbackCmd": "git_status"
     })
 
@@ -270,8 +915,6 @@ class GitCommand(sublime_plugin.TextCommand):
       return
     manager = MANAGERS[view.id()]
 
-    pos = view.sel()[0]
-
     folders = []
     if all:
       config = manager.load_config()
@@ -280,9 +923,7 @@ class GitCommand(sublime_plugin.TextCommand):
           folders.append(folder)
 
     else:
-      folder = manager.get_entry(pos)
-      if folder != None:
-        folders.append(folder)
+      folders = manager.get_entries(view.sel())
 
     self.execute(command, folders)
 
@@ -305,21 +946,31 @@ class GitPush(sublime_plugin.TextCommand):
       return
     manager = MANAGERS[view.id()]
 
-    pos = view.sel()[0]
-    folder = manager.get_entry(pos)
+    folders = manager.get_entries(view.sel())
     config = manager.load_config()
 
-    repo = self.get_selected_module_config(config, folder)
+    commands = []
+    git = self.settings.get("git_command")
+    for folder in folders:
+      repo = self.get_selected_module_config(config, folder)
+      if repo != None:
+        cmd = [git] + ["push", "origin", repo["branch"]];
+        commands.append({"cmd": cmd, "working_dir": repo["path"]})
 
-    if repo != None:
-      git = self.settings.get("git_command")
-      cmd = [git] + ["push", "origin", repo["branch"]];
-      commands = [{"cmd": cmd, "working_dir": repo["path"]}]
+    if len(commands) > 0:
       self.view.window().run_command("batch_exec", {
         "commands": commands,
         "callbackCmd": "git_status"
       })
 
+class GitFetchAllCommand(sublime_plugin.TextCommand):
+
+  def run(self, edit):
+
+    if not self.view.id() in MANAGERS:
+      return
+    MANAGERS[self.view.id()].fetch()
+
 class GitToggleStatusCommand(sublime_plugin.TextCommand):
 
   def run(self, edit):
@@ -329,8 +980,69 @@ class GitToggleStatusCommand(sublime_plugin.TextCommand):
     manager = MANAGERS[self.view.id()]
 
     manager.short = not manager.short
-    #self.view.window().run_command("git_status")
-    manager.update()
+    manager.render_results(manager.window.folders())
+
+class GitExpandStatusCommand(sublime_plugin.TextCommand):
+
+  def run(self, edit, more=False):
+
+    if not self.view.id() in MANAGERS:
+      return
+    manager = MANAGERS[self.view.id()]
+
+    manager.expand(manager.get_entries(self.view.sel()), more)
+
+class GitDiffCommand(sublime_plugin.TextCommand):
+
+  def run(self, edit):
+
+    if not self.view.id() in MANAGERS:
+      return
+    manager = MANAGERS[self.view.id()]
+
+    found = manager.get_file(self.view.sel()[0])
+    if found == None:
+      sublime.status_message("No changed file under the cursor")
+      return
+    manager.show_diff(*found)
+
+class GitToggleBranchesCommand(sublime_plugin.TextCommand):
+
+  def run(self, edit):
+
+    if not self.view.id() in MANAGERS:
+      return
+    manager = MANAGERS[self.view.id()]
+
+    manager.show_branches = not manager.show_branches
+    if manager.show_branches:
+      # the branches have not been collected yet
+      manager.update(force=True)
+    else:
+      for status in manager.results.values():
+        if isinstance(status, RepoStatus):
+          status.branches = None
+      manager.render_results(manager.window.folders())
+
+class GitPerformanceReportCommand(sublime_plugin.WindowCommand):
+
+  def run(self):
+    view = self.window.new_file()
+    view.set_name("Git Performance")
+    view.set_scratch(True)
+    edit = view.begin_edit()
+    view.insert(edit, 0, TRACER.report())
+    view.end_edit(edit)
+    view.set_read_only(True)
+
+class GitExportTraceCommand(sublime_plugin.WindowCommand):
+
+  def run(self, path=None):
+    if path == None:
+      path = os.path.join(tempfile.gettempdir(), "substance-git-trace.json")
+    TRACER.export_chrome(path)
+    sublime.status_message("Git trace written to %s"%path)
+    print("Git trace written to %s (open it in chrome://tracing)"%path)
 
 class GitCommitListener(sublime_plugin.EventListener):
 
@@ -339,6 +1051,10 @@ class GitCommitListener(sublime_plugin.EventListener):
       return True
     return None
 
+  def on_close(self, view):
+    if view.id() in MANAGERS:
+      MANAGERS.pop(view.id()).close()
+
   def on_activated(self, view):
 
     if not view.id() in MANAGERS:
@@ -8,88 +8,478 @@ import os
 import subprocess
 from subprocess import Popen, PIPE
 import sys
+import signal
 import json
+import time
+import threading
+from tracing import TracedPopen
 
-def _Popen(cmd, folder, stdout=None, stderr=None):
+class GitTimeoutError(Exception):
+  """Raised when a git process was killed because it ran past its deadline."""
+
+# the number of running repository watchers, see watch_index()
+_WATCHERS = [0]
+_WATCHERS_LOCK = threading.Lock()
+
+def watch_index(watching):
+  """Registers a started (True) or stopped (False) repository watcher.
+
+  While a watcher runs, git must not rewrite the index when we only look at
+  it: the watcher would take that for a change and refresh again.
+  """
+  with _WATCHERS_LOCK:
+    _WATCHERS[0] += 1 if watching else -1
+
+def _Popen(cmd, folder, stdout=None, stderr=None, new_group=False, write_index=False, **kwargs):
   startupinfo = None
   if os.name == 'nt':
     startupinfo = subprocess.STARTUPINFO()
     startupinfo.dwFlags |= subprocess.STARTF_USESHOWWINDOW
-  return subprocess.Popen(cmd, stdout=stdout, stderr=stderr, cwd=folder, startupinfo=startupinfo)
+  elif new_group:
+    # in its own process group, so that hooks and remote helpers can be killed too;
+    # preexec_fn is slow and not thread safe, only fetches need it
+    kwargs['preexec_fn'] = os.setsid
+  if _WATCHERS[0] > 0 and not write_index:
+    kwargs['env'] = dict(kwargs.get('env') or os.environ, GIT_OPTIONAL_LOCKS='0')
+  proc = TracedPopen(cmd, stdout=stdout, stderr=stderr, cwd=folder, startupinfo=startupinfo, **kwargs)
+  proc.new_group = new_group and os.name != 'nt'
+  return proc
+
+def _kill(proc):
+  proc.expired = True
+  try:
+    if proc.new_group:
+      os.killpg(proc.pid, signal.SIGKILL)
+    else:
+      proc.kill()
+  except OSError:
+    pass # already gone
+
+def _watch(proc, deadline):
+  # kills `proc` once `deadline` (a time.time() value) passed
+  if deadline is None:
+    return None
+  timer = threading.Timer(max(deadline - time.time(), 0), _kill, (proc,))
+  timer.start()
+  return timer
+
+def _unwatch(proc, timer):
+  if timer is not None:
+    timer.cancel()
+    if getattr(proc, 'expired', False):
+      raise GitTimeoutError("git process %d was killed at its deadline" % proc.pid)
+
+def _communicate(proc, deadline=None):
+  """Like `proc.communicate()` but raises GitTimeoutError once `deadline` passed."""
+  timer = _watch(proc, deadline)
+  try:
+    output = proc.communicate()
+  finally:
+    _unwatch(proc, timer)
+  return output
+
+def git_dir(folder):
+  # `.git` may be a file pointing to the actual directory (worktrees, submodules)
+  path = os.path.join(folder, '.git')
+  if os.path.isfile(path):
+    with open(path, 'r') as f:
+      content = f.read().strip()
+    if content.startswith('gitdir:'):
+      path = os.path.normpath(os.path.join(folder, content[7:].strip()))
+  return path
+
+def _common_dir(gitdir):
+  try:
+    with open(os.path.join(gitdir, 'commondir'), 'r') as f:
+      return os.path.normpath(os.path.join(gitdir, f.read().strip()))
+  except (IOError, OSError):
+    return gitdir
+
+def repo_id(folder):
+  """Returns a path identifying the repository of `folder`, shared by its worktrees."""
+  return os.path.realpath(_common_dir(git_dir(folder)))
+
+def _stat(path):
+  try:
+    st = os.stat(path)
+    return (st.st_mtime, st.st_size)
+  except OSError:
+    return None
+
+# parsed config and packed-refs files by path, validated by mtime and size
+_FILE_CACHE = {}
+_FILE_CACHE_LOCK = threading.Lock()
+
+def _read_cached(path, parse):
+  fingerprint = _stat(path)
+  key = (path, parse)
+  with _FILE_CACHE_LOCK:
+    entry = _FILE_CACHE.get(key)
+  if entry is not None and entry[0] == fingerprint:
+    return entry[1]
+  value = parse(path) if fingerprint is not None else parse(None)
+  with _FILE_CACHE_LOCK:
+    _FILE_CACHE[key] = (fingerprint, value)
+  return value
+
+def _read_lines(path):
+  if path is None:
+    return []
+  try:
+    with open(path, 'rb') as f:
+      return f.read().decode('utf-8', 'replace').splitlines()
+  except (IOError, OSError):
+    return []
+
+def _config_value(value):
+  result = []
+  quoted = False
+  escaped = False
+  for c in value:
+    if escaped:
+      result.append({'n': '\n', 't': '\t', 'b': '\b'}.get(c, c))
+      escaped = False
+    elif c == '\\':
+      escaped = True
+    elif c == '"':
+      quoted = not quoted
+    elif (c == '#' or c == ';') and not quoted:
+      break
+    else:
+      result.append(c)
+  return ''.join(result).strip()
+
+def _parse_config(path):
+  # a flat {"section.subsection.key": value} map; the last value of a key wins
+  values = {}
+  section = ''
+  for line in _read_lines(path):
+    line = line.strip()
+    if not line or line[0] in '#;':
+      continue
+    if line[0] == '[':
+      header = line[1:line.find(']')]
+      if '"' in header:
+        name, subsection = header.split('"', 1)
+        section = '%s.%s' % (name.strip().lower(), subsection.rsplit('"', 1)[0])
+      else:
+        section = header.strip().lower()
+      if section == 'include' or section.startswith('includeif'):
+        values['__include__'] = True
+      continue
+    key, sep, value = line.partition('=')
+    key = key.strip().lower()
+    values['%s.%s' % (section, key)] = _config_value(value) if sep else 'true'
+  return values
+
+def _parse_packed_refs(path):
+  refs = {}
+  for line in _read_lines(path):
+    if not line or line[0] in '#^':
+      continue
+    sha, _, ref = line.partition(' ')
+    refs[ref.strip()] = sha
+  return refs
+
+def read_git_config(gitdir):
+  return _read_cached(os.path.join(_common_dir(gitdir), 'config'), _parse_config)
+
+def resolve_ref(gitdir, ref, depth=5):
+  """Resolves a ref to a sha using loose refs and packed-refs."""
+  commondir = _common_dir(gitdir)
+  for base in (gitdir, commondir):
+    path = os.path.join(base, ref)
+    if os.path.isfile(path):
+      with open(path, 'r') as f:
+        content = f.read().strip()
+      if content.startswith('ref: '):
+        if depth == 0:
+          return None
+        return resolve_ref(gitdir, content[5:], depth - 1)
+      return content
+  return _read_cached(os.path.join(commondir, 'packed-refs'), _parse_packed_refs).get(ref)
+
+def upstream_ref(remote, merge):
+  if not merge:
+    return None
+  if remote == '.': # local
+    return merge
+  return 'refs/remotes/%s/%s' % (remote, merge[11:])
+
+def read_repo_state(folder):
+  """Reads branch, sha and tracking configuration directly from `.git`.
+
+  Returns None if `folder` is not a repository or uses a layout this reader
+  does not understand (reftable, config includes), in which case git has to
+  be asked instead.
+  """
+  gitdir = git_dir(folder)
+  try:
+    with open(os.path.join(gitdir, 'HEAD'), 'r') as f:
+      head = f.read().strip()
+  except (IOError, OSError):
+    return None
+  config = read_git_config(gitdir)
+  if '__include__' in config or config.get('extensions.refstorage', 'files') != 'files':
+    return None
+
+  branch = None
+  remote = None
+  merge = None
+  if head.startswith('ref: '):
+    ref = head[5:]
+    if not ref.startswith('refs/heads/'):
+      return None
+    branch = ref[11:]
+    sha = resolve_ref(gitdir, ref)
+    remote = config.get('branch.%s.remote' % branch)
+    if remote:
+      merge = config.get('branch.%s.merge' % branch)
+  else:
+    sha = head
+
+  return {
+    "gitdir": gitdir,
+    "branch": branch,
+    "sha": sha,
+    "remote": remote,
+    "merge": merge
+  }
+
+def repo_fingerprint(folder):
+  """Returns a cheap stat based fingerprint of the repository state.
+
+  It changes whenever the index, HEAD, the current branch, its upstream,
+  packed refs or the stash are written. Edits of the working tree that have not
+  touched the index are not detected.
+  """
+  gitdir = git_dir(folder)
+  commondir = _common_dir(gitdir)
+  try:
+    with open(os.path.join(gitdir, 'HEAD'), 'r') as f:
+      head = f.read().strip()
+  except (IOError, OSError):
+    return None
+  config = read_git_config(gitdir)
+  paths = [
+    os.path.join(gitdir, 'index'),
+    os.path.join(gitdir, 'HEAD'),
+    os.path.join(commondir, 'packed-refs'),
+    os.path.join(commondir, 'refs', 'stash')
+  ]
+  if head.startswith('ref: '):
+    ref = head[5:]
+    paths.append(os.path.join(commondir, ref))
+    if ref.startswith('refs/heads/'):
+      branch = ref[11:]
+      remote = config.get('branch.%s.remote' % branch)
+      if remote:
+        upstream = upstream_ref(remote, config.get('branch.%s.merge' % branch))
+      else:
+        upstream = 'refs/remotes/origin/%s' % branch
+      if upstream:
+        paths.append(os.path.join(commondir, upstream))
+  return tuple([head] + [_stat(p) for p in paths])
+
+class StatusCache(object):
+  """LRU cache for status results, validated by `repo_fingerprint`.
+
+  Entries older than `max_age` seconds are treated as stale so that working
+  tree edits show up eventually. It is safe to use from several threads.
+  """
+
+  def __init__(self, max_entries=256, max_age=30):
+    self.max_entries = max_entries
+    self.max_age = max_age
+    self.entries = {}
+    self.lock = threading.Lock()
+    self.tick = 0
+    self.hits = 0
+    self.misses = 0
+    self.evictions = 0
+
+  def get(self, key, fingerprint):
+    with self.lock:
+      entry = self.entries.get(key)
+      if (entry is None or fingerprint is None or entry["fingerprint"] != fingerprint
+          or (self.max_age and time.time() - entry["time"] > self.max_age)):
+        self.misses += 1
+        return None
+      self.hits += 1
+      self.tick += 1
+      entry["tick"] = self.tick
+      return entry["value"]
+
+  def put(self, key, fingerprint, value):
+    with self.lock:
+      self.tick += 1
+      self.entries[key] = {
+        "fingerprint": fingerprint,
+        "value": value,
+        "time": time.time(),
+        "tick": self.tick
+      }
+      while len(self.entries) > self.max_entries:
+        oldest = min(self.entries, key=lambda k: self.entries[k]["tick"])
+        del self.entries[oldest]
+        self.evictions += 1
+
+  def invalidate(self, key=None):
+    with self.lock:
+      if key is None:
+        self.entries.clear()
+      else:
+        self.entries.pop(key, None)
+
+  def invalidate_folder(self, folder):
+    with self.lock:
+      for key in [key for key in self.entries if key[0] == folder]:
+        del self.entries[key]
+
+  def stats(self):
+    with self.lock:
+      return {
+        "entries": len(self.entries),
+        "hits": self.hits,
+        "misses": self.misses,
+        "evictions": self.evictions
+      }
+
+def git_repo_info(folder, git_command='git', deadline=None):
+  state = read_repo_state(folder)
+  if state is not None:
+    return {
+      "path": folder,
+      "remote": state["remote"],
+      "branch": state["branch"] or ''
+    }
 
-def git_repo_info(folder, git_command='git'):
   gitsym = _Popen([git_command, 'symbolic-ref', 'HEAD'], folder, stdout=PIPE, stderr=PIPE)
-  branch, error = gitsym.communicate()
+  branch, error = _communicate(gitsym, deadline)
   error_string = error.decode('utf-8')
   if 'fatal: Not a git repository' in error_string:
     raise Exception(error_string)
   branch = branch.decode('utf-8').strip()[11:]
-  remote_name = _Popen([git_command,'config','branch.%s.remote' % branch], folder, stdout=PIPE).communicate()[0].strip()
+  remote_name = _communicate(_Popen([git_command,'config','branch.%s.remote' % branch], folder, stdout=PIPE), deadline)[0].strip()
   if not remote_name:
     remote_name = None
+  else:
+    remote_name = remote_name.decode('utf-8')
   return {
     "path": folder,
     "remote": remote_name,
     "branch": branch
   }
 
-def gitstatus(folder, git_command='git', plain_only=False):
+def git_fetch(folder, remote=None, git_command='git', timeout=None):
+  """Fetches `remote` (or the default remote) and returns the outcome as a dict.
 
-  if (plain_only):
-    status_plain = _Popen([git_command, 'status'], folder, stdout=PIPE).communicate()[0]
-    sha = _Popen([git_command,'rev-parse', 'HEAD'], folder, stdout=PIPE).communicate()[0].strip()
-    return {
-      "status": status_plain,
-      "sha": sha
-    }
-  gitsym = _Popen([git_command, 'symbolic-ref', 'HEAD'], folder, stdout=PIPE, stderr=PIPE)
-  branch, error = gitsym.communicate()
-  error_string = error.decode('utf-8')
-  if 'fatal: Not a git repository' in error_string:
-    return None
-  branch = branch.decode('utf-8').strip()[11:]
-  res, err = _Popen([git_command, 'diff', '--name-status'], folder, stdout=PIPE, stderr=PIPE).communicate()
+  The fetch is killed after `timeout` seconds, together with the transport
+  processes it spawned. Credential prompts are disabled, a remote asking for
+  a password fails instead of hanging.
+  """
+  cmd = [git_command, 'fetch', '--quiet']
+  if remote:
+    cmd.append(remote)
+  env = os.environ.copy()
+  env['GIT_TERMINAL_PROMPT'] = '0'
+  start = time.time()
+  deadline = None
+  if timeout:
+    deadline = start + timeout
+  proc = _Popen(cmd, folder, stdout=PIPE, stderr=PIPE, new_group=True, env=env)
+  try:
+    output, error = _communicate(proc, deadline)
+  except GitTimeoutError:
+    return {"ok": False, "timed_out": True, "error": "", "elapsed": time.time() - start}
+  return {
+    "ok": proc.returncode == 0,
+    "timed_out": False,
+    "error": error.decode('utf-8', 'replace').strip(),
+    "elapsed": time.time() - start
+  }
+
+UNTRACKED_MODES = ('no', 'normal', 'all')
+
+# folders whose index got the untracked cache written
+_UNTRACKED_CACHE = set()
+
+def _writes_untracked_cache(folder, config):
+  # git reads the untracked cache with GIT_OPTIONAL_LOCKS=0, but only stores it
+  # in the index with the optional lock; the first status of an opted-in folder
+  # may take it, later ones leave the index alone for the watcher
+  return 'core.untrackedCache=true' in config and not folder in _UNTRACKED_CACHE
+
+def _status_args(git_command, untracked, config):
+  # `git -c key=value ... status -u<mode>`, `config` enables e.g. the untracked cache
+  cmd = [git_command]
+  for option in config:
+    cmd.extend(['-c', option])
+  cmd.append('status')
+  if untracked:
+    cmd.append('-u%s' % untracked)
+  return cmd
+
+def _tracking(folder, branch, git_command, deadline=None, state=None):
+  """Returns the configured remote and merge ref of `branch`, None where not set."""
+  if state is None:
+    state = read_repo_state(folder)
+  if state is not None and state["branch"] == branch:
+    return state["remote"], state["merge"]
+  values = []
+  for key in ('remote', 'merge'):
+    value = _communicate(_Popen([git_command, 'config', 'branch.%s.%s' % (branch, key)], folder, stdout=PIPE), deadline)[0]
+    values.append(value.strip().decode('utf-8', 'replace') or None)
+  return values[0], values[1]
+
+def _gitstatus_legacy(folder, git_command, deadline=None, untracked='all', config=()):
+  state = read_repo_state(folder)
+  if state is not None:
+    branch = state["branch"] or ''
+  else:
+    gitsym = _Popen([git_command, 'symbolic-ref', 'HEAD'], folder, stdout=PIPE, stderr=PIPE)
+    branch, error = _communicate(gitsym, deadline)
+    error_string = error.decode('utf-8')
+    if 'fatal: Not a git repository' in error_string:
+      return None
+    branch = branch.decode('utf-8').strip()[11:]
+  write_index = _writes_untracked_cache(folder, config)
+  status, err = _communicate(_Popen(_status_args(git_command, untracked or 'all', config) + ['-s'], folder,
+    stdout=PIPE, stderr=PIPE, write_index=write_index), deadline)
   err_string = err.decode('utf-8')
 
   if 'fatal' in err_string:
     return None
+  if write_index:
+    _UNTRACKED_CACHE.add(folder)
 
-  changed_files = [namestat[0] for namestat in res.splitlines()]
-  staged_files = [namestat[0] for namestat in _Popen([git_command,'diff', '--staged','--name-status'], folder, stdout=PIPE).communicate()[0].splitlines()]
-  nb_changed = len(changed_files) - changed_files.count('U')
-  nb_U = staged_files.count('U')
-  nb_staged = len(staged_files) - nb_U
-  staged = nb_staged
-  conflicts = nb_U
-  changed = nb_changed
-  status = _Popen([git_command,'status','-s','-uall'], folder, stdout=PIPE).communicate()[0]
   status_lines = status.splitlines()
-  untracked_lines = [a for a in map(lambda s: s.decode('utf-8'), status_lines) if a.startswith("??")]
-  nb_untracked = len(untracked_lines)
-  untracked = nb_untracked
-  stashes = _Popen([git_command,'stash','list'], folder, stdout=PIPE).communicate()[0].splitlines()
-  nb_stashed = len(stashes)
-  stashed = nb_stashed
-
-  if not nb_changed and not nb_staged and not nb_U and not nb_untracked and not nb_stashed:
-    clean = True
-  else:
-    clean = False
+  entries = _parse_short([line.decode('utf-8', 'replace') for line in status_lines])
+  totals = count_entries(entries)
+  stashes = _communicate(_Popen([git_command,'stash','list'], folder, stdout=PIPE), deadline)[0].splitlines()
+  stashed = len(stashes)
+  clean = not (totals["staged"] or totals["conflicts"] or totals["changed"] or totals["untracked"] or stashed)
 
   remote = ''
+  remote_name = None
+  upstream = None
+  ahead = 0
+  behind = 0
 
-  tag, tag_error = _Popen([git_command, 'describe', '--exact-match'], folder, stdout=PIPE, stderr=PIPE).communicate()
-  sha = _Popen([git_command,'rev-parse','HEAD'], folder, stdout=PIPE).communicate()[0].strip()
+  tag, tag_error = _communicate(_Popen([git_command, 'describe', '--exact-match'], folder, stdout=PIPE, stderr=PIPE), deadline)
+  tag = tag.strip().decode('utf-8', 'replace')
+  sha = _communicate(_Popen([git_command,'rev-parse','HEAD'], folder, stdout=PIPE), deadline)[0].strip().decode('utf-8')
 
   if not branch: # not on any branch
     if tag: # if we are on a tag, print the tag's name
       branch = tag
     else:
-      branch = symbols['prehash'] + sha.decode('utf-8')[:-1]
+      branch = symbols['prehash'] + sha
   else:
-    remote_name = _Popen([git_command,'config','branch.%s.remote' % branch], folder, stdout=PIPE).communicate()[0].strip()
-    if remote_name:
-      merge_name = _Popen([git_command,'config','branch.%s.merge' % branch], folder, stdout=PIPE).communicate()[0].strip()
+    remote_name, merge_name = _tracking(folder, branch, git_command, deadline, state)
+    # a remote without a merge ref is no upstream, as for `git status`
+    if remote_name and merge_name:
+      upstream = merge_name[11:] if remote_name == '.' else '%s/%s' % (remote_name, merge_name[11:])
     else:
       remote_name = "origin"
       merge_name = "refs/heads/%s" % branch
@@ -98,13 +488,14 @@ def gitstatus(folder, git_command='git', plain_only=False):
       remote_ref = merge_name
     else:
       remote_ref = 'refs/remotes/%s/%s' % (remote_name, merge_name[11:])
-    revgit = _Popen([git_command, 'rev-list', '--left-right', '%s...HEAD' % remote_ref], folder, stdout=PIPE, stderr=PIPE)
-    revlist = revgit.communicate()[0]
+    # counts only, the commits themselves are never listed
+    revgit = _Popen([git_command, 'rev-list', '--left-right', '--count', '%s...HEAD' % remote_ref], folder, stdout=PIPE, stderr=PIPE)
+    revlist = _communicate(revgit, deadline)[0]
     if revgit.poll(): # fallback to local
-      revlist = _Popen([git_command, 'rev-list', '--left-right', '%s...HEAD' % merge_name], folder, stdout=PIPE, stderr=PIPE).communicate()[0]
-    behead = revlist.splitlines()
-    ahead = len([x for x in behead if x[0]=='>'])
-    behind = len(behead) - ahead
+      revlist = _communicate(_Popen([git_command, 'rev-list', '--left-right', '--count', '%s...HEAD' % merge_name], folder, stdout=PIPE, stderr=PIPE), deadline)[0]
+    counts = revlist.split()
+    if len(counts) == 2:
+      behind, ahead = int(counts[0]), int(counts[1])
     if behind:
       remote += '%s%s' % (symbols['behind'], behind)
     if ahead:
@@ -114,21 +505,746 @@ def gitstatus(folder, git_command='git', plain_only=False):
     remote = '.'
 
   result = {
-    "remote": str(remote_name),
-    "branch": str(branch),
-    "sha": str(sha),
+    "remote": remote_name,
+    "branch": branch,
+    "sha": sha,
     "ahead": ahead,
     "behind": behind,
+    "staged": totals["staged"],
+    "conflicts": totals["conflicts"],
+    "changed": totals["changed"],
+    "untracked": totals["untracked"],
+    "stashed": stashed,
+    "clean": clean,
+    "detached": remote_name is None,
+    "upstream": upstream,
+    "entries": entries,
+    "status": status
+  }
+  return result
+
+def _iter_records(stream, chunk_size=2**15, on_read=None):
+  # yields the NUL terminated records of a `-z` output while it is being read
+  pending = b''
+  while True:
+    data = os.read(stream.fileno(), chunk_size)
+    if not data:
+      break
+    if on_read:
+      on_read(len(data))
+    records = (pending + data).split(b'\0')
+    pending = records.pop()
+    for record in records:
+      yield record.decode('utf-8', 'replace')
+  if pending:
+    yield pending.decode('utf-8', 'replace')
+
+CONFLICTS = ('DD', 'AU', 'UD', 'UA', 'DU', 'AA', 'UU')
+
+class FileEntry(object):
+  """A changed file: its index and worktree status letters as in `git status -s`."""
+  __slots__ = ('index', 'worktree', 'path', 'orig_path', 'blob')
+
+  def __init__(self, index, worktree, path, orig_path=None, blob=None):
+    self.index = index
+    self.worktree = worktree
+    self.path = path
+    self.orig_path = orig_path
+    # sha of the blob in the index, if known
+    self.blob = blob
+
+  @property
+  def conflicted(self):
+    return self.index + self.worktree in CONFLICTS
+
+  @property
+  def untracked(self):
+    return self.index == '?'
+
+  @property
+  def staged(self):
+    return not (self.untracked or self.conflicted) and self.index != ' '
+
+  @property
+  def changed(self):
+    return not (self.untracked or self.conflicted) and self.worktree != ' '
+
+  def short(self):
+    if self.orig_path:
+      return '%s%s %s -> %s' % (self.index, self.worktree, self.orig_path, self.path)
+    return '%s%s %s' % (self.index, self.worktree, self.path)
+
+class RepoStatus(object):
+  """The status of a repository, as returned by `gitstatus`, in compact form."""
+  __slots__ = ('folder', 'sha', 'branch', 'detached', 'upstream', 'ahead', 'behind', 'stashed', 'entries', 'elapsed',
+    'checked', 'branches')
+
+  def __init__(self, folder, stat):
+    self.folder = folder
+    self.sha = stat['sha']
+    self.branch = stat['branch']
+    self.detached = stat['detached']
+    self.upstream = stat['upstream']
+    self.ahead = stat['ahead']
+    self.behind = stat['behind']
+    self.stashed = stat['stashed']
+    self.entries = stat['entries']
+    self.elapsed = stat['elapsed']
+    # when git ran; cached results keep the time of the run they came from
+    self.checked = stat.get('checked')
+    # the BranchInfo of all local branches, when asked for
+    self.branches = None
+
+  @property
+  def clean(self):
+    return len(self.entries) == 0
+
+  @property
+  def synced(self):
+    return self.ahead == 0 and self.behind == 0
+
+def count_entries(entries):
+  """Counts the entries per section, the same way for the porcelain and the legacy status.
+
+  A file with staged and unstaged changes counts as staged and as changed;
+  conflicted and untracked files count only as such.
+  """
+  return {
+    "staged": len([entry for entry in entries if entry.staged]),
+    "conflicts": len([entry for entry in entries if entry.conflicted]),
+    "changed": len([entry for entry in entries if entry.changed]),
+    "untracked": len([entry for entry in entries if entry.untracked])
+  }
+
+def _parse_short(lines):
+  # the entries of a `git status -s` output
+  entries = []
+  for line in lines:
+    if len(line) < 4:
+      continue
+    path = line[3:]
+    orig_path = None
+    if line[0] in 'RC' and ' -> ' in path:
+      orig_path, path = path.split(' -> ', 1)
+    entries.append(FileEntry(line[0], line[1], path, orig_path))
+  return entries
+
+class BranchInfo(object):
+  """A local branch and how far it is from its upstream."""
+  __slots__ = ('name', 'upstream', 'ahead', 'behind', 'gone', 'current')
+
+  def __init__(self, name, upstream, ahead=0, behind=0, gone=False, current=False):
+    self.name = name
+    self.upstream = upstream
+    self.ahead = ahead
+    self.behind = behind
+    self.gone = gone
+    self.current = current
+
+  @property
+  def diverged(self):
+    return self.gone or self.ahead > 0 or self.behind > 0
+
+def parse_branch_overview(output):
+  # records of `for-each-ref --format=BRANCH_FORMAT`
+  branches = []
+  for line in output.splitlines():
+    fields = line.split('\0')
+    if len(fields) != 4:
+      continue
+    name, upstream, track, head = fields
+    branch = BranchInfo(name, upstream or None, current=head == '*')
+    for part in track.split(', '):
+      if part == 'gone':
+        branch.gone = True
+      elif part.startswith('ahead '):
+        branch.ahead = int(part[6:])
+      elif part.startswith('behind '):
+        branch.behind = int(part[7:])
+    branches.append(branch)
+  return branches
+
+BRANCH_FORMAT = '%(refname:short)%00%(upstream:short)%00%(upstream:track,nobracket)%00%(HEAD)'
+
+def branch_overview(folder, git_command='git', deadline=None):
+  """Returns a BranchInfo for every local branch, from a single `git for-each-ref`."""
+  proc = _Popen([git_command, 'for-each-ref', '--format=' + BRANCH_FORMAT, 'refs/heads'], folder, stdout=PIPE, stderr=PIPE)
+  output, error = _communicate(proc, deadline)
+  if proc.returncode:
+    return None
+  return parse_branch_overview(output.decode('utf-8', 'replace'))
+
+def branches_fingerprint(folder):
+  """Stats of packed-refs and every loose branch and remote branch ref.
+
+  Directory mtimes are not enough: updating `refs/heads/feature/x` in place
+  does not touch `refs/heads`.
+  """
+  gitdir = git_dir(folder)
+  commondir = _common_dir(gitdir)
+  paths = [os.path.join(gitdir, 'HEAD'), os.path.join(commondir, 'packed-refs')]
+  for top in (os.path.join(commondir, 'refs', 'heads'), os.path.join(commondir, 'refs', 'remotes')):
+    for root, dirs, files in os.walk(top):
+      dirs.sort()
+      paths.extend([os.path.join(root, name) for name in sorted(files)])
+  return tuple([(path, _stat(path)) for path in paths])
+
+def cached_branch_overview(cache, folder, git_command='git', deadline=None):
+  """Like `branch_overview` but only runs git if a ref of the repository moved."""
+  key = (folder, 'branches')
+  branches = cache.get(key, branches_fingerprint(folder))
+  if branches is None:
+    branches = branch_overview(folder, git_command, deadline)
+    if branches is not None:
+      cache.put(key, branches_fingerprint(folder), branches)
+  return branches
+
+def parse_porcelain_v2(records):
+  info = {
+    "oid": None,
+    "head": None,
+    "upstream": None,
+    "ahead": 0,
+    "behind": 0,
+    "stashed": 0,
+    "entries": []
+  }
+  entries = info["entries"]
+  records = iter(records)
+  for record in records:
+    kind = record[:1]
+    if kind == '#':
+      key, _, value = record[2:].partition(' ')
+      if key == 'branch.oid':
+        info["oid"] = None if value == '(initial)' else value
+      elif key == 'branch.head':
+        info["head"] = None if value == '(detached)' else value
+      elif key == 'branch.upstream':
+        info["upstream"] = value
+      elif key == 'branch.ab':
+        ahead, behind = value.split(' ')
+        info["ahead"] = int(ahead[1:])
+        info["behind"] = int(behind[1:])
+      elif key == 'stash':
+        info["stashed"] = int(value)
+    elif kind == '1' or kind == '2':
+      xy = record[2:4].replace('.', ' ')
+      if kind == '1':
+        fields = record.split(' ', 8)
+        entries.append(FileEntry(xy[0], xy[1], fields[8], blob=fields[7]))
+      else:
+        # renames and copies carry the original path as an extra record
+        orig_path = next(records)
+        fields = record.split(' ', 9)
+        entries.append(FileEntry(xy[0], xy[1], fields[9], orig_path, blob=fields[7]))
+    elif kind == 'u':
+      entries.append(FileEntry(record[2], record[3], record.split(' ', 10)[10]))
+    elif kind == '?':
+      entries.append(FileEntry('?', '?', record[2:]))
+  info.update(count_entries(entries))
+  info["lines"] = [entry.short() for entry in entries]
+  return info
+
+def _gitstatus_porcelain(folder, git_command, deadline=None, untracked=None, config=()):
+  cmd = _status_args(git_command, untracked, config) + ['--porcelain=v2', '--branch', '--show-stash', '-z']
+  write_index = _writes_untracked_cache(folder, config)
+  proc = _Popen(cmd, folder, stdout=PIPE, stderr=PIPE, write_index=write_index)
+  timer = _watch(proc, deadline)
+  # stderr is drained on the side, git would block once its pipe is full
+  errors = []
+  drain = threading.Thread(target=lambda: errors.append(proc.stderr.read()))
+  drain.start()
+  try:
+    info = parse_porcelain_v2(_iter_records(proc.stdout, on_read=proc.trace_read))
+    proc.stdout.close()
+    returncode = proc.wait()
+    drain.join()
+    proc.stderr.close()
+  finally:
+    _unwatch(proc, timer)
+  error_string = b''.join(errors).decode('utf-8', 'replace')
+  if returncode:
+    if 'not a git repository' in error_string.lower():
+      return None
+    # git versions without porcelain v2 or --show-stash
+    return _gitstatus_legacy(folder, git_command, deadline, untracked, config)
+  if write_index:
+    _UNTRACKED_CACHE.add(folder)
+
+  sha = info["oid"] or ''
+  branch = info["head"]
+  if not branch: # not on any branch
+    tag = _communicate(_Popen([git_command, 'describe', '--exact-match'], folder, stdout=PIPE, stderr=PIPE), deadline)[0].strip()
+    if tag: # if we are on a tag, print the tag's name
+      branch = tag.decode('utf-8')
+    else:
+      branch = symbols['prehash'] + sha
+    remote_name = None
+  elif info["upstream"]:
+    # "." for a local upstream, and remote names may contain slashes
+    remote_name = _tracking(folder, branch, git_command, deadline)[0] or info["upstream"].split('/', 1)[0]
+  else:
+    remote_name = "origin"
+
+  staged = info["staged"]
+  conflicts = info["conflicts"]
+  changed = info["changed"]
+  untracked = info["untracked"]
+  stashed = info["stashed"]
+  clean = not (staged or conflicts or changed or untracked or stashed)
+
+  return {
+    "remote": remote_name,
+    "branch": branch,
+    "sha": sha,
+    "ahead": info["ahead"],
+    "behind": info["behind"],
     "staged": staged,
     "conflicts": conflicts,
     "changed": changed,
     "untracked": untracked,
     "stashed": stashed,
     "clean": clean,
-    "status": status
+    "detached": not info["head"],
+    "upstream": info["upstream"],
+    "entries": info["entries"],
+    "status": '\n'.join(info["lines"])
   }
-  return result
+
+def gitstatus(folder, git_command='git', plain_only=False, porcelain=True, deadline=None, untracked=None, config=()):
+  """Returns the status of the repository in `folder`.
+
+  With a `deadline` (a time.time() value) git processes still running at
+  that time are killed and GitTimeoutError is raised. `untracked` is one of
+  UNTRACKED_MODES, None leaves it to git. `config` holds "key=value" options
+  passed to `git status`. The time taken is returned as "elapsed" and the
+  time.time() the check started as "checked".
+  """
+
+  if (plain_only):
+    status_plain = _communicate(_Popen([git_command, 'status'], folder, stdout=PIPE), deadline)[0]
+    sha = _communicate(_Popen([git_command,'rev-parse', 'HEAD'], folder, stdout=PIPE), deadline)[0].strip()
+    return {
+      "status": status_plain,
+      "sha": sha
+    }
+
+  # a single `git status --porcelain=v2` call instead of about ten git processes;
+  # the multi-call implementation is kept for comparison
+  start = time.time()
+  if porcelain:
+    stat = _gitstatus_porcelain(folder, git_command, deadline, untracked, config)
+  else:
+    stat = _gitstatus_legacy(folder, git_command, deadline, untracked, config)
+  if stat is not None:
+    stat["elapsed"] = time.time() - start
+    stat["checked"] = start
+  return stat
+
+def _cached_gitstatus(cache, folder, git_command, plain_only, porcelain, deadline, untracked, config):
+  # returns the status and whether git had to run
+  key = (folder, plain_only, porcelain, untracked, tuple(config))
+  fingerprint = repo_fingerprint(folder)
+  stat = cache.get(key, fingerprint)
+  if stat is not None:
+    return stat, False
+  stat = gitstatus(folder, git_command=git_command, plain_only=plain_only, porcelain=porcelain, deadline=deadline,
+    untracked=untracked, config=config)
+  if stat is not None:
+    # `git status` may refresh the index, so the fingerprint is taken again
+    cache.put(key, repo_fingerprint(folder), stat)
+  return stat, True
+
+def cached_gitstatus(cache, folder, git_command='git', plain_only=False, porcelain=True, deadline=None, untracked=None, config=()):
+  """Like `gitstatus` but only runs git if the repository fingerprint moved."""
+  return _cached_gitstatus(cache, folder, git_command, plain_only, porcelain, deadline, untracked, config)[0]
+
+def diff_key(folder, entry, sha):
+  """Identifies the diff of `entry` by content: the index blob, HEAD and the stat of the file.
+
+  Without the blob sha of the index (legacy status) the stat of the index is used.
+  """
+  index = entry.blob or _stat(os.path.join(git_dir(folder), 'index'))
+  return (os.path.realpath(folder), entry.path, entry.index + entry.worktree, sha, index,
+    _stat(os.path.join(folder, entry.path)))
+
+def _truncate(text, max_chars, complete=True):
+  # `complete` is False when the output was not read to its end
+  if complete and (not max_chars or len(text) <= max_chars):
+    return text
+  if max_chars:
+    text = text[:max_chars]
+  cut = text.rfind('\n') + 1 or len(text)
+  if not complete:
+    return text[:cut] + '\n... diff truncated after %d characters\n' % cut
+  return text[:cut] + '\n... diff truncated, showing %d of %d characters\n' % (cut, len(text))
+
+def _read_limited(proc, limit=None, deadline=None):
+  """Reads the stdout of `proc` until it closes or more than `limit` bytes arrived.
+
+  A process with more output is killed. Returns the output and whether it
+  was read to its end.
+  """
+  timer = _watch(proc, deadline)
+  chunks = []
+  size = 0
+  complete = True
+  try:
+    while True:
+      data = os.read(proc.stdout.fileno(), 2**15)
+      if not data:
+        break
+      proc.trace_read(len(data))
+      chunks.append(data)
+      size += len(data)
+      if limit is not None and size > limit:
+        complete = False
+        try:
+          proc.kill()
+        except OSError:
+          pass # already gone
+        break
+    proc.stdout.close()
+    proc.wait()
+  finally:
+    _unwatch(proc, timer)
+  return b''.join(chunks), complete
+
+def _untracked_dir(folder, entry, git_command, deadline, max_chars):
+  # the untracked mode "normal" reports new directories, not their files
+  proc = _Popen([git_command, 'ls-files', '--others', '--exclude-standard', '-z', '--', entry.path], folder,
+    stdout=PIPE, stderr=PIPE)
+  output, error = _communicate(proc, deadline)
+  if proc.returncode:
+    return None
+  files = [name for name in output.decode('utf-8', 'replace').split(u'\0') if name]
+  lines = [u'Untracked directory %s with %d files:' % (entry.path, len(files)), u'']
+  lines.extend([u'  %s' % name for name in files])
+  return _truncate(u'\n'.join(lines) + u'\n', max_chars)
+
+def git_diff(folder, entry, git_command='git', deadline=None, max_chars=None):
+  """Returns the staged and unstaged diff of a single file, None if git failed.
+
+  Untracked directories are listed with the files they contain.
+  """
+  diff = [git_command, 'diff', '--no-color', '--no-ext-diff']
+  if entry.untracked and (entry.path.endswith('/') or os.path.isdir(os.path.join(folder, entry.path))):
+    return _untracked_dir(folder, entry, git_command, deadline, max_chars)
+  if entry.untracked:
+    # git takes "/dev/null" as the empty file on every platform, os.devnull is "nul" on Windows
+    commands = [diff + ['--no-index', '--', '/dev/null', entry.path]]
+  elif entry.conflicted:
+    commands = [diff + ['--', entry.path]]
+  else:
+    commands = []
+    if entry.staged:
+      paths = [entry.orig_path, entry.path] if entry.orig_path else [entry.path]
+      commands.append(diff + ['--cached', '-M', '--'] + paths)
+    if entry.changed:
+      commands.append(diff + ['--', entry.path])
+  # large diffs are only read up to `max_chars`, their git process is killed
+  output = []
+  size = 0
+  complete = True
+  devnull = open(os.devnull, 'wb')
+  try:
+    for cmd in commands:
+      proc = _Popen(cmd, folder, stdout=PIPE, stderr=devnull)
+      out, complete = _read_limited(proc, max_chars - size if max_chars else None, deadline)
+      if not complete:
+        output.append(out)
+        break
+      # `--no-index` exits with 1 if the files differ
+      if proc.returncode and not (entry.untracked and proc.returncode == 1):
+        return None
+      output.append(out)
+      size += len(out)
+  finally:
+    devnull.close()
+  return _truncate(b''.join(output).decode('utf-8', 'replace'), max_chars, complete)
+
+class DiffCache(object):
+  """LRU cache for diffs keyed by `diff_key`, bounded by the total length of the diffs.
+
+  It is safe to use from several threads.
+  """
+
+  def __init__(self, max_chars=2**22):
+    self.max_chars = max_chars
+    self.entries = {}
+    self.size = 0
+    self.lock = threading.Lock()
+    self.tick = 0
+    self.hits = 0
+    self.misses = 0
+    self.evictions = 0
+
+  def get(self, key):
+    with self.lock:
+      entry = self.entries.get(key)
+      if entry is None:
+        self.misses += 1
+        return None
+      self.hits += 1
+      self.tick += 1
+      entry["tick"] = self.tick
+      return entry["value"]
+
+  def put(self, key, value):
+    with self.lock:
+      if len(value) > self.max_chars:
+        return
+      self._remove(key)
+      self.tick += 1
+      self.entries[key] = {"value": value, "tick": self.tick}
+      self.size += len(value)
+      while self.size > self.max_chars:
+        oldest = min(self.entries, key=lambda k: self.entries[k]["tick"])
+        self._remove(oldest)
+        self.evictions += 1
+
+  def _remove(self, key):
+    entry = self.entries.pop(key, None)
+    if entry is not None:
+      self.size -= len(entry["value"])
+
+  def invalidate_folder(self, folder):
+    with self.lock:
+      for key in [key for key in self.entries if key[0] == folder]:
+        self._remove(key)
+
+  def stats(self):
+    with self.lock:
+      return {
+        "entries": len(self.entries),
+        "size": self.size,
+        "hits": self.hits,
+        "misses": self.misses,
+        "evictions": self.evictions
+      }
+
+class _Request(object):
+  # a status request in flight, which other threads can wait for
+  __slots__ = ('event', 'result', 'error')
+
+  def __init__(self):
+    self.event = threading.Event()
+    self.result = None
+    self.error = None
+
+class StatusStore(object):
+  """Status results shared by all views, keyed by the real path of a repository.
+
+  Concurrent requests for the same repository run git only once. Subscribers
+  are told when a repository they show got a new result, and the results of
+  repositories nobody subscribes to any more are dropped.
+  """
+
+  def __init__(self, cache, diffs=None):
+    self.cache = cache
+    self.diffs = diffs if diffs is not None else DiffCache()
+    self.lock = threading.Lock()
+    self.requests = {}
+    self.subscriptions = {}
+    self.subscribers = {}
+
+  def subscribe(self, subscriber, folders):
+    """Makes `subscriber.on_shared_status(real_path)` get called for `folders`."""
+    real_paths = set([os.path.realpath(folder) for folder in folders])
+    with self.lock:
+      released = self._release(subscriber, real_paths)
+      self.subscriptions[subscriber] = real_paths
+      for real_path in real_paths:
+        self.subscribers.setdefault(real_path, set()).add(subscriber)
+    self._evict(released)
+
+  def unsubscribe(self, subscriber):
+    with self.lock:
+      released = self._release(subscriber, set())
+      self.subscriptions.pop(subscriber, None)
+    self._evict(released)
+
+  def _release(self, subscriber, keep):
+    # returns the repositories left without subscribers
+    released = []
+    for real_path in self.subscriptions.get(subscriber, set()) - keep:
+      subscribers = self.subscribers.get(real_path)
+      subscribers.discard(subscriber)
+      if len(subscribers) == 0:
+        del self.subscribers[real_path]
+        released.append(real_path)
+    return released
+
+  def _evict(self, real_paths):
+    for real_path in real_paths:
+      self.cache.invalidate_folder(real_path)
+      self.diffs.invalidate_folder(real_path)
+
+  def invalidate(self, folder):
+    self.cache.invalidate_folder(os.path.realpath(folder))
+
+  def _request(self, key, deadline, compute):
+    # runs `compute` unless the same request is already running elsewhere
+    with self.lock:
+      request = self.requests.get(key)
+      owner = request is None
+      if owner:
+        request = self.requests[key] = _Request()
+    if not owner:
+      timeout = None
+      if deadline is not None:
+        timeout = max(deadline - time.time(), 0)
+      if not request.event.wait(timeout) and not request.event.is_set():
+        raise GitTimeoutError("gave up waiting for git in %s" % key[0])
+      if request.error is not None:
+        raise request.error
+      return request.result, False
+    try:
+      request.result = compute()
+    except Exception as err:
+      request.error = err
+      raise
+    finally:
+      with self.lock:
+        del self.requests[key]
+      request.event.set()
+    return request.result, True
+
+  def status(self, folder, git_command='git', porcelain=True, deadline=None, untracked=None, config=(), source=None):
+    """Like `cached_gitstatus` for the real path of `folder`.
+
+    Subscribers other than `source` are told when git ran.
+    """
+    real_path = os.path.realpath(folder)
+    key = (real_path, porcelain, untracked, tuple(config), git_command)
+    (stat, ran_git), owner = self._request(key, deadline, lambda: _cached_gitstatus(self.cache, real_path,
+      git_command, False, porcelain, deadline, untracked, config))
+    if owner and ran_git:
+      self.publish(real_path, source)
+    return stat
+
+  def branches(self, folder, git_command='git', deadline=None):
+    """Like `cached_branch_overview` for the real path of `folder`."""
+    real_path = os.path.realpath(folder)
+    return self._request((real_path, 'branches', git_command), deadline,
+      lambda: cached_branch_overview(self.cache, real_path, git_command, deadline))[0]
+
+  def diff(self, folder, entry, sha, git_command='git', deadline=None, max_chars=None):
+    """Like `git_diff`, but only runs git if the file, its index blob or HEAD changed."""
+    if entry.untracked and entry.path.endswith('/'):
+      # the stat of a directory misses changes further down, it is listed every time
+      return git_diff(os.path.realpath(folder), entry, git_command, deadline, max_chars)
+    key = diff_key(folder, entry, sha)
+    text = self.diffs.get(key)
+    if text is None:
+      text = self._request((key[0], 'diff') + key[1:], deadline,
+        lambda: git_diff(os.path.realpath(folder), entry, git_command, deadline, max_chars))[0]
+      if text is not None:
+        self.diffs.put(key, text)
+    return text
+
+  def publish(self, real_path, source=None):
+    with self.lock:
+      subscribers = list(self.subscribers.get(real_path, ()))
+    for subscriber in subscribers:
+      if subscriber is not source:
+        subscriber.on_shared_status(real_path)
+
+def _text(value):
+  if isinstance(value, bytes):
+    return value.decode('utf-8', 'replace')
+  return value
+
+def status_record(folder, stat):
+  """Returns `stat` as a JSON serializable dict."""
+  record = {"folder": folder}
+  for key, value in stat.items():
+    if key == 'entries':
+      value = [entry.short() for entry in value]
+    elif key == 'branches':
+      value = [{"name": b.name, "upstream": b.upstream, "ahead": b.ahead, "behind": b.behind,
+        "gone": b.gone, "current": b.current} for b in value]
+    record[key] = _text(value)
+  return record
+
+def main(argv=None):
+  """Checks many repositories concurrently and prints one JSON object per line.
+
+  Every repository is printed as soon as it was checked, followed by a
+  summary line. The exit status is 1 if any repository failed or timed out.
+  """
+  import argparse
+  # imported here, as utils imports this module
+  from utils import parallel_map, read_project_config
+  parser = argparse.ArgumentParser(description=main.__doc__.splitlines()[0])
+  parser.add_argument("folders", nargs="*", help="repositories to check (default: the current directory)")
+  parser.add_argument("--root", action="append", default=[], help="also check the git modules of this project")
+  parser.add_argument("-j", "--jobs", type=int, default=8, help="repositories checked at a time")
+  parser.add_argument("--git", default="git", help="git executable")
+  parser.add_argument("--legacy", action="store_true", help="use the multi-process status implementation")
+  parser.add_argument("--untracked", choices=UNTRACKED_MODES, help="untracked files mode")
+  parser.add_argument("--timeout", type=float, help="seconds per repository")
+  parser.add_argument("--branches", action="store_true", help="include the upstream state of all local branches")
+  args = parser.parse_args(argv)
+
+  folders = list(args.folders)
+  if args.root:
+    # discovery reports on stdout, which is reserved for the records
+    stdout = sys.stdout
+    sys.stdout = sys.stderr
+    try:
+      for root in args.root:
+        folders.extend(sorted(read_project_config(root, args.git, args.jobs).keys()))
+    finally:
+      sys.stdout = stdout
+  elif not folders:
+    folders.append(os.getcwd())
+  seen = set()
+  unique = []
+  for folder in folders:
+    real_path = os.path.realpath(folder)
+    if not real_path in seen:
+      seen.add(real_path)
+      unique.append(folder)
+
+  lock = threading.Lock()
+  summary = {"summary": True, "repos": len(unique), "dirty": 0, "ahead": 0, "behind": 0,
+    "errors": 0, "timed_out": 0}
+
+  def check(folder):
+    deadline = None
+    if args.timeout:
+      deadline = time.time() + args.timeout
+    try:
+      stat = gitstatus(folder, git_command=args.git, porcelain=not args.legacy, deadline=deadline,
+        untracked=args.untracked)
+      if stat is None:
+        record = {"folder": folder, "error": "not a git repository"}
+      else:
+        if args.branches:
+          stat["branches"] = branch_overview(folder, args.git, deadline) or []
+        record = status_record(folder, stat)
+    except GitTimeoutError:
+      record = {"folder": folder, "error": "timed out", "timed_out": True}
+    except (IOError, OSError) as err:
+      record = {"folder": folder, "error": str(err)}
+    with lock:
+      if "error" in record:
+        summary["errors"] += 1
+        if record.get("timed_out"):
+          summary["timed_out"] += 1
+      else:
+        summary["dirty"] += 0 if record["clean"] else 1
+        summary["ahead"] += 1 if record["ahead"] else 0
+        summary["behind"] += 1 if record["behind"] else 0
+      sys.stdout.write(json.dumps(record) + "\n")
+      sys.stdout.flush()
+
+  start = time.time()
+  parallel_map(check, unique, args.jobs)
+  summary["elapsed"] = time.time() - start
+  sys.stdout.write(json.dumps(summary) + "\n")
+  return 1 if summary["errors"] else 0
 
 if __name__ == "__main__":
-  stat = gitstatus(os.getcwd())
-  print(json.dumps(stat))
+  sys.exit(main())
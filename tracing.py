@@ -0,0 +1,183 @@
+# Records spawned processes and phase timings to find out where refreshes
+# spend their time.
+
+import os
+import json
+import time
+import threading
+import subprocess
+from collections import deque
+
+class Tracer(object):
+  """Keeps the most recent process and phase events.
+
+  Process events carry the command, working directory, duration, exit code
+  and the number of bytes read. Phase events are recorded with `span`.
+  """
+
+  def __init__(self, max_events=5000, max_refreshes=20):
+    self.lock = threading.Lock()
+    self.events = deque(maxlen=max_events)
+    self.refreshes = deque(maxlen=max_refreshes)
+    self.spawns = 0
+    self.origin = time.time()
+
+  def add(self, event):
+    with self.lock:
+      self.events.append(event)
+      if event["cat"] == "process":
+        self.spawns += 1
+    return event
+
+  def span(self, name, **args):
+    return _Span(self, name, args)
+
+  def begin_refresh(self):
+    return {"start": time.time(), "spawns": self.spawns, "phases": {}}
+
+  def end_refresh(self, refresh):
+    refresh["duration"] = time.time() - refresh["start"]
+    refresh["spawns"] = self.spawns - refresh["spawns"]
+    with self.lock:
+      self.refreshes.append(refresh)
+
+  def snapshot(self):
+    with self.lock:
+      return list(self.events), list(self.refreshes)
+
+  def report(self, limit=15):
+    events, refreshes = self.snapshot()
+    processes = [e for e in events if e["cat"] == "process"]
+    finished = [e for e in processes if e["dur"] != None]
+    lines = ["Git performance report", "======================", ""]
+
+    lines.append("Recent refreshes:")
+    for refresh in reversed(refreshes):
+      phases = ", ".join(["%s %.0f ms"%(name, duration * 1000) for name, duration in sorted(refresh["phases"].items())])
+      if "cache" in refresh:
+        phases += "; cache %d hits, %d misses"%(refresh["cache"]["hits"], refresh["cache"]["misses"])
+      lines.append("  %s  %6.0f ms  %4d processes  %s"%(time.strftime("%H:%M:%S", time.localtime(refresh["start"])),
+        refresh["duration"] * 1000, refresh["spawns"], phases))
+    lines.append("")
+
+    repos = {}
+    for e in finished:
+      repo = e["args"]["cwd"]
+      total, count = repos.get(repo, (0.0, 0))
+      repos[repo] = (total + e["dur"], count + 1)
+    lines.append("Slowest repositories (total process time):")
+    for repo, (total, count) in sorted(repos.items(), key=lambda item: item[1][0], reverse=True)[:limit]:
+      lines.append("  %8.0f ms  %4d processes  %s"%(total * 1000, count, repo))
+    lines.append("")
+
+    lines.append("Slowest commands:")
+    for e in sorted(finished, key=lambda e: e["dur"], reverse=True)[:limit]:
+      lines.append("  %8.0f ms  exit %s  %7d bytes  %s  (%s)"%(e["dur"] * 1000, e["args"]["exit_code"],
+        e["args"]["bytes"], e["name"], e["args"]["cwd"]))
+    lines.append("")
+
+    counts = {}
+    for e in processes:
+      counts[e["name"]] = counts.get(e["name"], 0) + 1
+    lines.append("Spawn counts:")
+    for name, count in sorted(counts.items(), key=lambda item: item[1], reverse=True):
+      lines.append("  %6d  %s"%(count, name))
+    running = len(processes) - len(finished)
+    if running:
+      lines.append("")
+      lines.append("%d processes still running or not waited for."%running)
+    return "\n".join(lines) + "\n"
+
+  def export_chrome(self, filename):
+    """Writes the events in the Chrome trace event format (chrome://tracing)."""
+    events, refreshes = self.snapshot()
+    trace = []
+    for e in events:
+      if e["dur"] == None:
+        continue
+      trace.append({
+        "name": e["name"],
+        "cat": e["cat"],
+        "ph": "X",
+        "ts": int((e["ts"] - self.origin) * 1e6),
+        "dur": int(e["dur"] * 1e6),
+        "pid": os.getpid(),
+        "tid": e["tid"],
+        "args": e["args"]
+      })
+    with open(filename, "w") as f:
+      json.dump({"traceEvents": trace, "displayTimeUnit": "ms"}, f)
+
+class _Span(object):
+
+  def __init__(self, tracer, name, args):
+    self.tracer = tracer
+    self.name = name
+    self.args = args
+
+  def __enter__(self):
+    self.start = time.time()
+    return self
+
+  def __exit__(self, *exc):
+    duration = time.time() - self.start
+    self.tracer.add({"name": self.name, "cat": "phase", "ts": self.start, "dur": duration,
+      "tid": threading.current_thread().ident, "args": self.args})
+    self.duration = duration
+    return False
+
+TRACER = Tracer()
+
+def _command_name(args):
+  if isinstance(args, (list, tuple)):
+    name = os.path.basename(str(args[0]))
+    # name git calls by their sub-command
+    if name.startswith("git") and len(args) > 1:
+      return "%s %s"%(name, args[1])
+    return name
+  return str(args).split(" ")[0]
+
+class TracedPopen(subprocess.Popen):
+  """subprocess.Popen that reports itself to the tracer.
+
+  Duration and exit code are recorded when the process is waited for or
+  polled after exiting. Bytes are counted by `communicate`, or through
+  `trace_read` by callers reading the pipes themselves.
+  """
+
+  def __init__(self, args, **kwargs):
+    start = time.time()
+    subprocess.Popen.__init__(self, args, **kwargs)
+    self.trace_event = TRACER.add({
+      "name": _command_name(args),
+      "cat": "process",
+      "ts": start,
+      "dur": None,
+      "tid": threading.current_thread().ident,
+      "args": {"cmd": " ".join(args) if isinstance(args, (list, tuple)) else args,
+        "cwd": kwargs.get("cwd") or os.getcwd(), "exit_code": None, "bytes": 0}
+    })
+
+  def trace_read(self, count):
+    self.trace_event["args"]["bytes"] += count
+
+  def trace_finish(self):
+    if self.trace_event["dur"] == None and self.returncode != None:
+      self.trace_event["dur"] = time.time() - self.trace_event["ts"]
+      self.trace_event["args"]["exit_code"] = self.returncode
+
+  def communicate(self, *args, **kwargs):
+    out, err = subprocess.Popen.communicate(self, *args, **kwargs)
+    self.trace_read(len(out or b"") + len(err or b""))
+    self.trace_finish()
+    return out, err
+
+  def wait(self, *args, **kwargs):
+    code = subprocess.Popen.wait(self, *args, **kwargs)
+    self.trace_finish()
+    return code
+
+  def poll(self, *args, **kwargs):
+    code = subprocess.Popen.poll(self, *args, **kwargs)
+    self.trace_finish()
+    return code
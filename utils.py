@@ -2,7 +2,14 @@ import re
 import json
 import os
 import types
-from gitstatus import git_repo_info
+import time
+import threading
+try:
+  import Queue as queue
+except ImportError:
+  import queue
+from gitstatus import git_repo_info, git_dir, git_fetch, repo_id
+from tracing import TRACER
 
 # Converts a dict into a dynamic object
 class DictObject(dict):
@@ -37,6 +44,44 @@ def read_json(filename):
       print(ve)
       return None
 
+def parallel_map(func, items, workers=8):
+  """Calls `func` for every item using a bounded pool of threads.
+
+  The results are returned in the order of `items`. An exception raised by
+  `func` is re-raised after all workers have stopped.
+  """
+  items = list(items)
+  results = [None] * len(items)
+  if workers <= 1 or len(items) <= 1:
+    for idx, item in enumerate(items):
+      results[idx] = func(item)
+    return results
+
+  jobs = queue.Queue()
+  for idx, item in enumerate(items):
+    jobs.put((idx, item))
+  errors = []
+
+  def work():
+    while not errors:
+      try:
+        idx, item = jobs.get_nowait()
+      except queue.Empty:
+        return
+      try:
+        results[idx] = func(item)
+      except Exception as err:
+        errors.append(err)
+
+  threads = [threading.Thread(target=work) for i in range(min(workers, len(items)))]
+  for t in threads:
+    t.start()
+  for t in threads:
+    t.join()
+  if errors:
+    raise errors[0]
+  return results
+
 REPO_ID = "([a-zA-Z0-9_-]+)"
 GIT_REPO_EXPRESSION = re.compile(REPO_ID+"/"+REPO_ID+"(?:.git)?"+"(?:#"+REPO_ID+")?")
 SHA1_EXPRESSION = re.compile("[a-fA-F0-9]{40}");
@@ -45,31 +90,240 @@ PACKAGE_FILE = "package.json"
 def package_file(root):
   return os.path.join(root, PACKAGE_FILE)
 
+# parsed package.json files by path, validated by mtime and size
+PACKAGE_CACHE = {}
+PACKAGE_CACHE_LOCK = threading.Lock()
+
+def read_package(root):
+  """Returns the parsed package.json of `root` and whether it came from the cache."""
+  filename = package_file(root)
+  try:
+    st = os.stat(filename)
+  except OSError:
+    return None, False
+  fingerprint = (st.st_mtime, st.st_size)
+  with PACKAGE_CACHE_LOCK:
+    entry = PACKAGE_CACHE.get(filename)
+  if entry != None and entry[0] == fingerprint:
+    return entry[1], True
+  data = read_json(filename)
+  with PACKAGE_CACHE_LOCK:
+    PACKAGE_CACHE[filename] = (fingerprint, data)
+  return data, False
+
+class RepoDiscovery(object):
+  """Finds git backed dependencies in the node_modules tree of a project.
+
+  The tree is walked level by level; the package.json files and the git
+  repositories of a level are inspected concurrently. Modules are deduplicated
+  by their real path, which also guards against symlink cycles.
+  """
+
+  def __init__(self, git_command, workers=8):
+    self.git_command = git_command
+    self.workers = workers
+    self.lock = threading.Lock()
+    self.stats = {
+      "packages": 0,
+      "packages_cached": 0,
+      "packages_time": 0.0,
+      "repos": 0,
+      "git_time": 0.0,
+      "total_time": 0.0
+    }
+    # files whose fingerprints tell whether the result is still valid
+    self.watched = set()
+
+  def watch(self, filename):
+    with self.lock:
+      self.watched.add(filename)
+
+  def count(self, key, value=1):
+    with self.lock:
+      self.stats[key] += value
+
+  def dependencies(self, root):
+    t = time.time()
+    package_config, cached = read_package(root)
+    self.watch(package_file(root))
+    self.count("packages")
+    if cached:
+      self.count("packages_cached")
+    module_dirs = []
+    if package_config:
+      deps = {}
+      if "dependencies" in package_config:
+        deps.update(package_config["dependencies"])
+      if "devDependencies" in package_config:
+        deps.update(package_config["devDependencies"])
+      for name, version in deps.items():
+        match = GIT_REPO_EXPRESSION.match(version)
+        if match:
+          module_dir = os.path.join(root, 'node_modules', name);
+          # only take over modules with a non SHA-1 version
+          if os.path.exists(os.path.join(module_dir, '.git')):
+            self.watch(os.path.join(git_dir(module_dir), 'HEAD'))
+            module_dirs.append((module_dir, package_file(root)))
+          else:
+            self.watch(os.path.join(module_dir, '.git'))
+    self.count("packages_time", time.time() - t)
+    return module_dirs
+
+  def repo_info(self, module_dir):
+    t = time.time()
+    repo = git_repo_info(module_dir, git_command=self.git_command)
+    repo["path"] = module_dir
+    self.count("repos")
+    self.count("git_time", time.time() - t)
+    return repo
+
+  def find(self, root, config):
+    t = time.time()
+    visited = set([os.path.realpath(root)])
+    level = [root]
+    while len(level) > 0:
+      module_dirs = []
+      packages = {}
+      for found in parallel_map(self.dependencies, level, self.workers):
+        for module_dir, package in found:
+          real_path = os.path.realpath(module_dir)
+          if not real_path in visited:
+            visited.add(real_path)
+            module_dirs.append(module_dir)
+            packages[module_dir] = package
+      repos = parallel_map(self.repo_info, module_dirs, self.workers)
+      for repo in repos:
+        repo["package"] = packages[repo["path"]]
+        config[repo["path"]] = repo
+      level = module_dirs
+    self.count("total_time", time.time() - t)
+    return config
+
+  def report(self):
+    stats = self.stats
+    return ("Discovered %d repositories in %.0f ms (package.json: %d read, %d cached, %.0f ms; git: %.0f ms)"
+      %(stats["repos"], stats["total_time"] * 1000, stats["packages"] - stats["packages_cached"],
+        stats["packages_cached"], stats["packages_time"] * 1000, stats["git_time"] * 1000))
 
 def find_git_repos(root, config, git_command):
-  package_config = read_json(package_file(root))
-  deps = {}
-  if "dependencies" in package_config:
-    for name, version in package_config["dependencies"].iteritems():
-      deps[name] = version
-  if "devDependencies" in package_config:
-    for name, version in package_config["devDependencies"].iteritems():
-      deps[name] = version
-  for name, version in deps.iteritems():
-    match = GIT_REPO_EXPRESSION.match(version)
-    if match:
-      module_dir = os.path.join(root, 'node_modules', name);
-      # only take over modules with a non SHA-1 version
-      if os.path.exists(os.path.join(module_dir, '.git')):
-        repo = git_repo_info(module_dir, git_command=git_command)
-        repo["path"] = module_dir
-        config[module_dir] = repo
-        find_git_repos(module_dir, config, git_command)
-
-def read_project_config(root, git_command):
+  RepoDiscovery(git_command).find(root, config)
+
+def _discover_project(root, git_command, workers):
   config = {}
   repo = git_repo_info(root, git_command=git_command)
   repo["path"] = root
-  find_git_repos(root, config, git_command)
-  print(config)
-  return config
+  repo["package"] = None
+  config[root] = repo
+  discovery = RepoDiscovery(git_command, workers)
+  discovery.watch(os.path.join(git_dir(root), 'HEAD'))
+  discovery.watch(os.path.join(root, '.screwdriver', 'project.json'))
+  with TRACER.span("discovery", root=root):
+    discovery.find(root, config)
+  print(discovery.report())
+  return config, discovery.watched
+
+def read_project_config(root, git_command, workers=8):
+  return _discover_project(root, git_command, workers)[0]
+
+INDEX_FILE = "substance-modules.json"
+INDEX_VERSION = 1
+
+# project indexes by root, kept to avoid re-reading the index file
+PROJECT_INDEXES = {}
+
+def _fingerprint(filename):
+  try:
+    st = os.stat(filename)
+    return [st.st_mtime, st.st_size]
+  except OSError:
+    return None
+
+def index_file(root):
+  # stored inside the git directory so that it does not show up as untracked
+  return os.path.join(git_dir(root), INDEX_FILE)
+
+def _index_is_valid(index):
+  if index == None or index.get("version") != INDEX_VERSION:
+    return False
+  for filename, fingerprint in index["fingerprints"].items():
+    if _fingerprint(filename) != fingerprint:
+      return False
+  return True
+
+def load_project_index(root, git_command, workers=8):
+  """Returns the module index of a project, rediscovering it only when needed.
+
+  The index is persisted next to the project and is valid as long as none of
+  the package.json, .screwdriver/project.json and .git/HEAD files seen during
+  discovery changed.
+  """
+  index = PROJECT_INDEXES.get(root)
+  if index == None:
+    filename = index_file(root)
+    if os.path.exists(filename):
+      try:
+        with open(filename, 'r') as f:
+          index = json.load(f)
+      except (IOError, ValueError) as err:
+        print("Could not read module index %s: %s"%(filename, err))
+  if _index_is_valid(index):
+    PROJECT_INDEXES[root] = index
+    return index["modules"]
+
+  config, watched = _discover_project(root, git_command, workers)
+  modules = {}
+  for path, repo in config.items():
+    modules[path] = {
+      "path": repo["path"],
+      "branch": repo["branch"],
+      "remote": repo["remote"],
+      "package": repo["package"]
+    }
+  fingerprints = {}
+  for filename in watched:
+    fingerprints[filename] = _fingerprint(filename)
+  index = {"version": INDEX_VERSION, "modules": modules, "fingerprints": fingerprints}
+  PROJECT_INDEXES[root] = index
+
+  filename = index_file(root)
+  try:
+    with open(filename + ".tmp", 'w') as f:
+      json.dump(index, f, indent=2)
+    if os.path.exists(filename):
+      os.remove(filename)
+    os.rename(filename + ".tmp", filename)
+  except (IOError, OSError) as err:
+    print("Could not write module index %s: %s"%(filename, err))
+  return modules
+
+def fetch_all(repos, git_command, workers=4, timeout=60, on_fetched=None):
+  """Fetches the remotes of all `repos` with at most `workers` fetches at a time.
+
+  `repos` are module entries with "path" and "remote". Every remote of a
+  repository is fetched only once, also when the repository is reachable via
+  several paths or worktrees. `on_fetched(paths, result)` is called on the
+  worker thread as soon as a fetch completed, with all paths it affected.
+  Returns a list of (paths, result) pairs.
+  """
+  groups = {}
+  order = []
+  for repo in repos:
+    try:
+      key = (repo_id(repo["path"]), repo.get("remote"))
+    except (IOError, OSError) as err:
+      print("Skipping %s: %s"%(repo["path"], err))
+      continue
+    if not key in groups:
+      groups[key] = []
+      order.append(key)
+    groups[key].append(repo["path"])
+
+  def fetch(key):
+    paths = groups[key]
+    with TRACER.span("fetch", repo=paths[0], remote=key[1]):
+      result = git_fetch(paths[0], key[1], git_command=git_command, timeout=timeout)
+    if on_fetched != None:
+      on_fetched(paths, result)
+    return (paths, result)
+
+  return parallel_map(fetch, order, workers)
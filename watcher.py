@@ -0,0 +1,193 @@
+# Change detection for repositories: inotify on Linux, polling elsewhere.
+
+import os
+import sys
+import time
+import errno
+import select
+import struct
+import threading
+try:
+  import ctypes
+  import ctypes.util
+except ImportError:
+  ctypes = None
+from gitstatus import git_dir, repo_fingerprint, watch_index
+
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0x00000800
+IN_CLOEXEC = 0x00080000
+
+WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF
+
+# directories of the working tree which are not watched
+SKIPPED_DIRS = ('.git', 'node_modules')
+
+def _ignored(name):
+  # lock files and files written by the plugin itself
+  return name.endswith('.lock') or name.endswith('.tmp') or name == 'substance-modules.json'
+
+def _load_libc():
+  if ctypes == None or not sys.platform.startswith('linux'):
+    return None
+  try:
+    libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+    libc.inotify_init1
+    libc.inotify_add_watch
+    return libc
+  except (OSError, AttributeError):
+    return None
+
+class RepoWatcher(object):
+  """Reports repositories whose metadata or working tree changed.
+
+  `on_change` is called on the watcher thread with the set of changed
+  repositories. Events are collected until no new ones arrived for `settle`
+  seconds, but not longer than `max_delay` seconds, so that storms like an
+  `npm install` result in a single notification. At most `max_watches`
+  directories are watched; git metadata is watched first. Without inotify
+  the repository fingerprints are polled every `poll_interval` seconds.
+  """
+
+  def __init__(self, on_change, max_watches=4096, settle=0.3, max_delay=2.0, poll_interval=2.0):
+    self.on_change = on_change
+    self.max_watches = max_watches
+    self.settle = settle
+    self.max_delay = max_delay
+    self.poll_interval = poll_interval
+    self.repos = []
+    self.lock = threading.Lock()
+    self.watches = {}
+    self.dirty = set()
+    self.first_event = None
+    self.last_event = None
+    self.stopped = False
+    self.libc = _load_libc()
+    self.fd = None
+    self.thread = None
+
+  def start(self, repos):
+    self.repos = list(repos)
+    watch_index(True)
+    if self.libc != None:
+      self.fd = self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+      if self.fd < 0:
+        self.fd = None
+    if self.fd != None:
+      target = self.run_inotify
+    else:
+      target = self.run_polling
+    self.thread = threading.Thread(target=target)
+    self.thread.daemon = True
+    self.thread.start()
+
+  def stop(self):
+    if self.thread != None and not self.stopped:
+      self.stopped = True
+      watch_index(False)
+
+  def add_watch(self, path, repo):
+    if len(self.watches) >= self.max_watches:
+      return False
+    wd = self.libc.inotify_add_watch(self.fd, path.encode(sys.getfilesystemencoding()), WATCH_MASK)
+    if wd >= 0:
+      self.watches[wd] = (repo, path)
+    return True
+
+  def add_tree(self, path, repo):
+    for root, dirs, files in os.walk(path):
+      dirs[:] = [d for d in dirs if not d in SKIPPED_DIRS]
+      if not self.add_watch(root, repo):
+        return
+
+  def add_watches(self):
+    for repo in self.repos:
+      gitdir = git_dir(repo)
+      self.add_watch(gitdir, repo)
+      self.add_tree(os.path.join(gitdir, 'refs'), repo)
+    for repo in self.repos:
+      self.add_tree(repo, repo)
+    if len(self.watches) >= self.max_watches:
+      print("Git watcher: limit of %d watches reached, some folders are not watched"%self.max_watches)
+
+  def mark(self, repos):
+    now = time.time()
+    with self.lock:
+      self.dirty.update(repos)
+      if self.first_event == None:
+        self.first_event = now
+      self.last_event = now
+
+  def flush(self):
+    with self.lock:
+      if len(self.dirty) == 0:
+        return
+      now = time.time()
+      if now - self.last_event < self.settle and now - self.first_event < self.max_delay:
+        return
+      dirty = self.dirty
+      self.dirty = set()
+      self.first_event = None
+    self.on_change(dirty)
+
+  def read_events(self):
+    try:
+      data = os.read(self.fd, 2**16)
+    except OSError as e:
+      if e.errno == errno.EAGAIN:
+        return
+      raise
+    offset = 0
+    while offset < len(data):
+      wd, mask, cookie, length = struct.unpack_from('iIII', data, offset)
+      name = data[offset + 16:offset + 16 + length].rstrip(b'\0').decode(sys.getfilesystemencoding(), 'replace')
+      offset += 16 + length
+      if mask & IN_Q_OVERFLOW:
+        self.mark(self.repos)
+        continue
+      if mask & IN_IGNORED:
+        self.watches.pop(wd, None)
+        continue
+      if not wd in self.watches or _ignored(name):
+        continue
+      repo, path = self.watches[wd]
+      if mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO) and not name in SKIPPED_DIRS:
+        self.add_tree(os.path.join(path, name), repo)
+      self.mark([repo])
+
+  def run_inotify(self):
+    try:
+      # walking large working trees takes a while, it must not block the caller
+      self.add_watches()
+      while not self.stopped:
+        readable = select.select([self.fd], [], [], 0.1)[0]
+        if readable:
+          self.read_events()
+        self.flush()
+    finally:
+      os.close(self.fd)
+
+  def run_polling(self):
+    fingerprints = {}
+    for repo in self.repos:
+      fingerprints[repo] = repo_fingerprint(repo)
+    while not self.stopped:
+      time.sleep(self.poll_interval)
+      changed = []
+      for repo in self.repos:
+        fingerprint = repo_fingerprint(repo)
+        if fingerprint != fingerprints[repo]:
+          fingerprints[repo] = fingerprint
+          changed.append(repo)
+      if changed:
+        self.mark(changed)
+      self.flush()